@@ -0,0 +1,50 @@
+'''
+startup benchmark: measures `import ftracer` with
+`python -X importtime`, since the injected runner
+imports ftracer on every run.
+
+usage: python bench_startup.py [budget_ms] [runs]
+exits non-zero if the median import time exceeds budget_ms
+'''
+import os.path
+import statistics
+import subprocess
+import sys
+
+# target budget for the cumulative `import ftracer` time
+BUDGET_MS = 20.0
+
+
+def import_times(module='ftracer'):
+    '''
+    run `import <module>` in a fresh interpreter and
+    return a dict of imported module -> cumulative time (us)
+    '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MS
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    # warm up, e.g. write bytecode caches
+    import_times()
+    samples = [import_times() for _ in range(runs)]
+    median = statistics.median(times['ftracer'] for times in samples) / 1000
+    print(f'import ftracer: median {median:.1f}ms over {runs} runs (budget {budget:.1f}ms)')
+    print('heaviest imports (last run):')
+    heaviest = sorted(samples[-1].items(), key=lambda item: item[1], reverse=True)
+    for name, cumulative in heaviest[1:11]:
+        print(f'  {cumulative / 1000:7.1f}ms  {name}')
+    if median > budget:
+        print('over budget')
+        sys.exit(1)
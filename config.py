@@ -6,6 +6,22 @@ providing relevant config params as globals names
 # rel or abs path to cassettes dir
 cassettes_dir = './cassettes'
 
+# rel or abs path to the content addressed store of
+# recorded objects; shared by all cassettes
+blobs_dir = './cassettes/blobs'
+
+# a checkpoint, summarizing tracked objects, is recorded
+# every `checkpoint_events` events or `checkpoint_seconds`
+# seconds; players seek to the closest checkpoint instead
+# of replaying from the start. most checkpoints only list
+# objects tracked since the previous one; all tracked objects
+# are listed once those deltas add up to as many. so, however
+# frequent, checkpoints add, amortized, at most ~2 entries per
+# event to the cassette and to the time the traced program is
+# paused. more frequent checkpoints trade size for seek latency
+checkpoint_events = 10000
+checkpoint_seconds = 60.0
+
 
 if __name__ == '__main__':
     # do any init
@@ -14,3 +30,5 @@ if __name__ == '__main__':
     # make cassettes_dir
     if not os.path.isdir(cassettes_dir):
         os.mkdir(cassettes_dir)
+    if not os.path.isdir(blobs_dir):
+        os.mkdir(blobs_dir)
@@ -1,3 +1,19 @@
-from ._ftracer import set_trace
-from . import module_updater
-from . import player
+from ._ftracer import set_trace, set_recorder, record_bindings
+
+# attributes imported on first access; submodules with heavy
+# dependencies would otherwise slow down every injected runner
+_lazy_attrs = {
+    'install_import_hook': 'import_hook',
+    'uninstall_import_hook': 'import_hook',
+    'module_updater': None,
+    'player': None,
+}
+
+
+def __getattr__(name):
+    if name not in _lazy_attrs:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    import importlib
+    module_name = _lazy_attrs[name] or name
+    module = importlib.import_module(f'.{module_name}', __name__)
+    return module if _lazy_attrs[name] is None else getattr(module, name)
@@ -1,11 +1,56 @@
 import sys
 
-from functools import lru_cache
-from .ast_indexer import index_module
+from .ast_indexer import IndexCache, preindex_modules
 from .dynamic_trace import Tracer
+from .utils import find_modules
 
+# recorder used by instrumented code; see `set_recorder`
+_recorder = None
 
-def set_trace(target_path, runner_path, cassette_path=None):
-    tree_fn = lru_cache(index_module)
-    tracerfun = Tracer([target_path, runner_path], tree_fn, cassette_path=cassette_path)
+
+def set_trace(target_path, runner_path, cassette_path=None, preindex=False, package_dir=None,
+              stream_path=None):
+    '''
+    start recording a flow.
+
+    Args:
+        target_path: module to be analyzed
+        runner_path: module triggering the flow
+        cassette_path: location where cassette is recorded
+        preindex: index all traced modules in parallel
+            before tracing starts, instead of lazily
+            when the flow first enters each module
+        package_dir: additionally trace every module
+            under this directory
+        stream_path: also publish events live on a
+            unix socket at this path
+    '''
+    paths = [target_path, runner_path]
+    if package_dir is not None:
+        paths.extend(path for path in find_modules(package_dir) if path not in paths)
+    tree_fn = IndexCache()
+    if preindex:
+        tree_fn.update(preindex_modules(paths))
+    tracerfun = Tracer(paths, tree_fn, cassette_path=cassette_path, stream_path=stream_path)
     return sys.settrace(tracerfun)
+
+
+def set_recorder(target_path, runner_path, cassette_path=None, stream_path=None):
+    '''
+    start recording a flow from instrumented code,
+    i.e. modules rewritten by `module_updater.RecordingInjector`.
+    No trace hook is installed.
+    '''
+    global _recorder
+    _recorder = Tracer([target_path, runner_path], None, cassette_path=cassette_path,
+                       stream_path=stream_path)
+    return _recorder
+
+
+def record_bindings(filepath, lineno, bindings):
+    '''
+    called from instrumented code after `bindings`,
+    a dict of name -> value, were bound on `lineno`
+    '''
+    if _recorder is not None:
+        _recorder.record_bindings(filepath, lineno, bindings)
@@ -5,6 +5,7 @@ their child variables
 '''
 import ast
 import functools
+import time
 
 from collections import namedtuple
 from sortedcontainers import SortedList
@@ -72,6 +73,25 @@ class NameLinenoPair:
 # result type when resolving names in previous line
 LinenoNames = namedtuple('LinenoNames', 'lineno names')
 
+# ast nodes creating a comprehension scope
+_COMPREHENSIONS = (ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)
+
+
+def unwrap_target(node):
+    '''
+    if node is a collection, e.g. list, set, or tuple
+    return (recursively unwrapped) items, else return node.
+    Attribute and subscript targets, e.g. `self.x` or `d[k]`,
+    bind no name and are dropped.
+    '''
+    if type(node) in (ast.Tuple, ast.List, ast.Set):
+        return [item for elt in node.elts for item in unwrap_target(elt)]
+    elif isinstance(node, ast.Starred):
+        return unwrap_target(node.value)
+    elif isinstance(node, (ast.Attribute, ast.Subscript)):
+        return []
+    return [node]
+
 
 class LSNode(WNode):
     '''
@@ -79,8 +99,11 @@ class LSNode(WNode):
     Use for node representing a lexical scoping
     entity, e.g. functions, classes.
     '''
-    def __init__(self, name, astnode: ast.AST):
+    def __init__(self, name, astnode: ast.AST, indexed=True):
         super().__init__(name, astnode)
+        # whether the body of this scope has been walked;
+        # lazily indexed scopes are walked on first lookup
+        self.indexed = indexed
         self.lhs_children = {}
         self.rhs_children = {}
         # structure for looking up names on previous line
@@ -134,14 +157,25 @@ class NodeIndexer(ast.NodeVisitor):
     NB: code has to be analyzed in same way
     as python interpreter, i.e. read global definitions first
     then evaluate substructure.
+
+    When `lazy` is set, function and class bodies are
+    not walked when their definition is visited; instead
+    the scope is registered in `scope_range` and its body
+    is indexed the first time a line inside it is looked up.
     '''
-    def __init__(self):
+    def __init__(self, lazy=False):
+        self.lazy = lazy
         # `scope_stack` is a stack of nodes with an implied scope
         # used while actually walking the ast
         self.scope_stack = Stack()
         # `scope_range` structure is a
         # static map from lineno to scope stack
         self.scope_range = NORangeTree()
+        # lineno -> LinenoNames; `prev_lno_names` is called
+        # on every traced line so results are memoized.
+        # Indexing a deferred scope never changes the names of
+        # an already indexed scope, so entries never go stale.
+        self.lno_names = {}
         # TODO: allow searching for a name?
         super().__init__()
 
@@ -153,20 +187,50 @@ class NodeIndexer(ast.NodeVisitor):
         NOTE: this doesn't distinguish between
               (un)/resolved variables
         '''
-        scopes = self.scope_range.get_scope_stack(lineno)
-        # containing scope (LSNode)
-        cont_scope = scopes.top().value
-        return cont_scope.prev_lno_names(lineno)
+        try:
+            return self.lno_names[lineno]
+        except KeyError:
+            lno_names = self.containing_scope(lineno).prev_lno_names(lineno)
+            self.lno_names[lineno] = lno_names
+            return lno_names
+
+    def containing_scope(self, lineno) -> LSNode:
+        '''
+        get the innermost scope containing `lineno`,
+        indexing any lazily deferred scopes on the way
+        '''
+        while True:
+            scope = self.scope_range.innermost(lineno)
+            if scope is None:
+                raise IndexError(f'lineno {lineno} is outside all scopes')
+            # containing scope (LSNode)
+            cont_scope = scope.value
+            if cont_scope.indexed:
+                return cont_scope
+            # walking the body may register nested scopes
+            # that contain `lineno`; so look up again
+            self.index_scope(cont_scope)
+
+    def index_scope(self, node: LSNode):
+        '''
+        walk the body of a deferred scope
+        '''
+        node.indexed = True
+        self.scope_stack.push(node)
+        self.generic_visit(node.astnode)
+        self.scope_stack.pop()
 
     def push_scope(self, name:str, node: LSNode):
         '''
         entities that create a scope, e.g.
         functions, need to
-        pushed onto the scope stack
+        pushed onto the scope stack.
+        In lazy mode, the body walk is deferred.
         '''
-        self.scope_stack.push(node)
-        self.generic_visit(node.astnode)
-        self.scope_stack.pop()
+        if self.lazy:
+            node.indexed = False
+            return
+        self.index_scope(node)
 
     def add_lhs_child(self, name:str, node: LSNode, lineno: int=None):
         '''
@@ -179,6 +243,21 @@ class NodeIndexer(ast.NodeVisitor):
         parent = self.scope_stack.top()
         parent.add_lhs_child(name, node, lineno)
 
+    def compact(self):
+        '''
+        drop references to ast nodes so the index
+        is cheap to pickle, e.g. when shipping it
+        back from a worker process.
+        Only valid on a fully (non-lazily) built index.
+        '''
+        seen = set()
+        for scope in self.scope_range.values():
+            for child in scope.lhs_children.values():
+                if id(child) not in seen:
+                    seen.add(id(child))
+                    child.astnode = None
+            scope.astnode = None
+
     def add_rhs_child(self, name: str, node):
         '''
         a value object. Here we can track function
@@ -194,19 +273,40 @@ class NodeIndexer(ast.NodeVisitor):
         for field, value in ast.iter_fields(node):
             if isinstance(value, list):
                 for item in value:
-                    if isinstance(node, ast.AST):
+                    if isinstance(item, ast.AST):
                         self.visit(item)
             elif isinstance(value, ast.AST):
                 self.visit(value)
 
+    def bind_target(self, target, lineno: int=None, scope: LSNode=None):
+        '''
+        add the name(s) bound by assignment `target`
+        to `scope` (defaults to the current scope)
+        '''
+        scope = scope or self.scope_stack.top()
+        for part_target in self._unwrap(target):
+            tname = self._resolve_name(part_target)
+            tnode = WNode(tname, part_target)
+            # should this use a RVNode instead
+            scope.add_lhs_child(tname, tnode, lineno)
+
     def visit_Import(self, node):
-        for child in ast.iter_child_nodes(node):
-            name = child.asname or child.name
+        for child in node.names:
+            name = child.asname or child.name.partition('.')[0]
             wnode = WNode(name, node)
             # import creates a new name, i.e. like a lhs entity
             self.add_lhs_child(name, wnode)
         self.generic_visit(node)
 
+    def visit_ImportFrom(self, node):
+        for child in node.names:
+            if child.name == '*':
+                # names are unknown until runtime
+                continue
+            name = child.asname or child.name
+            self.add_lhs_child(name, WNode(name, node))
+        self.generic_visit(node)
+
     def visit_FunctionDef(self, node):
         # TODO: factor out commonalities from visit_{FunctionDef,
         # AsyncFunctionDef, ClassDef} into a helper
@@ -239,6 +339,57 @@ class NodeIndexer(ast.NodeVisitor):
         scope_name = f'ClassDef_{name}'
         self.push_scope(scope_name, lsnode)
 
+    def visit_Lambda(self, node):
+        '''
+        lambdas (and comprehensions) are scopes, but
+        being expressions they never contain a line
+        of their own; so they are not added to `scope_range`
+        and their names don't leak into the enclosing scope
+        '''
+        lsnode = LSNode('<lambda>', node)
+        self.index_scope(lsnode)
+
+    def _visit_comprehension_scope(self, node, elts):
+        # the first iterable is evaluated in the enclosing scope
+        generators = node.generators
+        self.visit(generators[0].iter)
+        lsnode = LSNode(f'<{node.__class__.__name__}>', node)
+        self.scope_stack.push(lsnode)
+        for i, generator in enumerate(generators):
+            if i > 0:
+                self.visit(generator.iter)
+            self.bind_target(generator.target, node.lineno)
+            self.visit(generator.target)
+            for cond in generator.ifs:
+                self.visit(cond)
+        for elt in elts:
+            self.visit(elt)
+        self.scope_stack.pop()
+
+    def visit_ListComp(self, node):
+        self._visit_comprehension_scope(node, [node.elt])
+
+    def visit_SetComp(self, node):
+        self._visit_comprehension_scope(node, [node.elt])
+
+    def visit_GeneratorExp(self, node):
+        self._visit_comprehension_scope(node, [node.elt])
+
+    def visit_DictComp(self, node):
+        self._visit_comprehension_scope(node, [node.key, node.value])
+
+    def visit_arguments(self, node):
+        '''
+        parameters are bound in the function/lambda scope
+        '''
+        args = node.posonlyargs + node.args + node.kwonlyargs
+        for arg in (node.vararg, node.kwarg):
+            if arg is not None:
+                args.append(arg)
+        for arg in args:
+            self.add_lhs_child(arg.arg, WNode(arg.arg, arg))
+        self.generic_visit(node)
+
     def visit_Module(self, node):
         '''
         first visited node
@@ -249,7 +400,8 @@ class NodeIndexer(ast.NodeVisitor):
         start = node.body[0].lineno
         end = node.body[-1].end_lineno
         self.scope_range.add_node(start, end, lsnode)
-        self.push_scope(name, lsnode)
+        # module level statements are always walked eagerly
+        self.index_scope(lsnode)
 
     def visit_Assign(self, node):
         '''
@@ -259,55 +411,206 @@ class NodeIndexer(ast.NodeVisitor):
         '''
         # not sure where there are multiple targets
         for target in node.targets:
-            # target may be a tuple of names
-            for part_target in self._unwrap(target):
-                tname = self._resolve_name(part_target)
-                tnode = WNode(tname, part_target)
-                # should this use a RVNode instead
-                self.add_lhs_child(tname, tnode, node.lineno)
-                # what about the value
-                # get the value from the runtime code object
-                # TODO: we should still do analysis
-                # of right hand side; here it's easier to
-                # distinguish (re)assignment vs. passing something
-                # around.
+            # target may be a (nested) tuple of names
+            self.bind_target(target, node.lineno)
+            # what about the value
+            # get the value from the runtime code object
+            # TODO: we should still do analysis
+            # of right hand side; here it's easier to
+            # distinguish (re)assignment vs. passing something
+            # around.
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        self.bind_target(node.target, node.lineno)
+        self.generic_visit(node)
+
+    def visit_AnnAssign(self, node):
+        # a bare annotation, i.e. `x: int`, binds nothing
+        if node.value is not None:
+            self.bind_target(node.target, node.lineno)
+        self.generic_visit(node)
+
+    def visit_For(self, node):
+        self.bind_target(node.target, node.lineno)
+        self.generic_visit(node)
+
+    visit_AsyncFor = visit_For
+
+    def visit_With(self, node):
+        for item in node.items:
+            if item.optional_vars is not None:
+                self.bind_target(item.optional_vars, node.lineno)
+        self.generic_visit(node)
+
+    visit_AsyncWith = visit_With
+
+    def visit_ExceptHandler(self, node):
+        if node.name is not None:
+            self.add_lhs_child(node.name, WNode(node.name, node), node.lineno)
+        self.generic_visit(node)
+
+    def visit_NamedExpr(self, node):
+        '''
+        the walrus binds in the closest enclosing
+        scope that is not a comprehension
+        '''
+        for scope in reversed(self.scope_stack.stack):
+            if not isinstance(scope.astnode, _COMPREHENSIONS):
+                break
+        self.bind_target(node.target, node.lineno, scope)
+        self.generic_visit(node)
+
+    def visit_MatchAs(self, node):
+        if node.name is not None:
+            self.add_lhs_child(node.name, WNode(node.name, node), node.lineno)
+        self.generic_visit(node)
+
+    def visit_MatchStar(self, node):
+        if node.name is not None:
+            self.add_lhs_child(node.name, WNode(node.name, node), node.lineno)
+        self.generic_visit(node)
+
+    def visit_MatchMapping(self, node):
+        if node.rest is not None:
+            self.add_lhs_child(node.rest, WNode(node.rest, node), node.lineno)
         self.generic_visit(node)
 
     def _resolve_name(self, node):
         '''
         extract name from node
         '''
-        if isinstance(node, ast.Attribute):
-            # TODO: is this case even triggered
-            name = node.attr
-        elif isinstance(node, ast.Name):
+        if isinstance(node, ast.Name):
             name = node.id
         else:
             raise ValueError(f'cannot resolve type: {type(node)}')
         return name
 
     def _unwrap(self, node):
-        '''
-        if node is a collection, e.g. list, set, or tuple
-        return items, else return node
-        '''
-        if type(node) in (ast.Tuple, ast.List, ast.Set):
-            return node.elts
-        return [node]
+        return unwrap_target(node)
 
 
-def index_module(module_path:str)->NodeIndexer:
+def index_module(module_path:str, lazy=True)->NodeIndexer:
     '''
     walk and index a module at `module_path`
-    and return the generated `NodeIndexer`
+    and return the generated `NodeIndexer`.
+
+    With `lazy`, only the module level statements
+    are walked up front; function and class bodies
+    are indexed on first lookup.
     '''
     with open(module_path) as fp:
         node = ast.parse(fp.read())
-    indexer = NodeIndexer()
+    indexer = NodeIndexer(lazy=lazy)
     indexer.visit(node)
     return indexer
 
 
+def _index_for_transfer(module_path: str):
+    '''
+    worker side of `preindex_modules`
+    '''
+    start = time.perf_counter()
+    indexer = index_module(module_path, lazy=False)
+    indexer.compact()
+    return indexer, time.perf_counter() - start
+
+
+def _index_results(module_paths, executor):
+    '''
+    generate (path, result) as modules are indexed, where
+    `result()` returns `_index_for_transfer(path)`, or raises.
+    Indexed in this process if `executor` is None
+    '''
+    if executor is None:
+        for path in module_paths:
+            yield path, functools.partial(_index_for_transfer, path)
+        return
+    from concurrent.futures import as_completed
+    futures = {executor.submit(_index_for_transfer, path): path
+               for path in module_paths}
+    for future in as_completed(futures):
+        yield futures[future], future.result
+
+
+def preindex_modules(module_paths, max_workers=None) -> dict:
+    '''
+    index `module_paths` in parallel worker processes.
+    Returns a dict of module path -> `NodeIndexer`.
+    Modules that fail to index are reported and
+    left out, i.e. they will be indexed lazily.
+
+    Workers are forked. This is called from the injected
+    runner's top level, which has no `__main__` guard; so
+    workers started with `spawn` or `forkserver` would re-run
+    the runner and die. Where fork is unavailable, e.g. Windows,
+    modules are indexed in this process instead.
+    '''
+    # imported here; they're heavy and preindexing is opt-in
+    import contextlib
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    module_paths = list(module_paths)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        executor = ProcessPoolExecutor(max_workers=max_workers,
+                                       mp_context=multiprocessing.get_context('fork'))
+    else:
+        executor = contextlib.nullcontext()
+    indexes = {}
+    start = time.perf_counter()
+    with executor as pool:
+        for path, result in _index_results(module_paths, pool):
+            try:
+                indexer, elapsed = result()
+            except Exception as exc:
+                print(f'preindex failed path={path} error={exc!r}')
+                continue
+            indexes[path] = indexer
+            print(f'preindexed [{len(indexes)}/{len(module_paths)}] path={path} '
+                  f'time={elapsed * 1000:.1f}ms')
+    elapsed = time.perf_counter() - start
+    print(f'preindexed {len(indexes)} modules in {elapsed * 1000:.1f}ms')
+    return indexes
+
+
+class IndexCache:
+    '''
+    memoizes `index_fn` per module path.
+    Unlike `functools.lru_cache`, the cache
+    can be warmed with indexes built elsewhere,
+    e.g. by `preindex_modules`.
+    '''
+    def __init__(self, index_fn=index_module):
+        self.index_fn = index_fn
+        self.indexes = {}
+
+    def __call__(self, module_path: str) -> NodeIndexer:
+        try:
+            return self.indexes[module_path]
+        except KeyError:
+            indexer = self.index_fn(module_path)
+            self.indexes[module_path] = indexer
+            return indexer
+
+    def update(self, indexes: dict):
+        self.indexes.update(indexes)
+
+
 if __name__ == '__main__':
-    indexer = index_module(realpath('./repos/foo/bar.py'))
-    # print(indexer.prev_unresolved(7))
+    # benchmark indexing and the `prev_lno_names` hot path
+    import sys
+    import timeit
+    path = realpath(sys.argv[1] if len(sys.argv) > 1 else './repos/foo/bar.py')
+    for lazy in (True, False):
+        elapsed = timeit.timeit(lambda: index_module(path, lazy=lazy), number=5) / 5
+        print(f'index_module lazy={lazy}: {elapsed * 1000:.2f}ms')
+    indexer = index_module(path)
+    # lines before the first statement are not in any scope
+    module_range, _ = indexer.scope_range.root.children[0]
+    lines = range(module_range.start, module_range.end + 1)
+    # first pass includes lazy indexing and filling the memo
+    for number in (1, 10):
+        elapsed = timeit.timeit(
+            lambda: [indexer.prev_lno_names(lno) for lno in lines],
+            number=number) / number
+        print(f'prev_lno_names: {elapsed / len(lines) * 1e6:.3f}us/line over {len(lines)} lines')
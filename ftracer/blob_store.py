@@ -0,0 +1,132 @@
+'''
+content addressed store for recorded payloads.
+
+each distinct payload is stored once, under its hash,
+and events reference the hash. the store is shared by
+all cassettes; so identical objects recorded by different
+runs are stored once.
+'''
+import functools
+import hashlib
+import os
+import os.path
+import time
+
+from .utils import to_abspath
+
+
+class BlobStore:
+    '''
+    blobs are stored as `<root>/<key[:2]>/<key>`,
+    where key is the hex BLAKE2b digest of the blob
+    '''
+    def __init__(self, root: str, cache_size: int=1024):
+        '''
+        Args:
+            root: dir of the store; created if missing
+            cache_size: number of blobs `get` keeps in memory
+        '''
+        self.root = to_abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        # keys known to be stored; saves a stat per `put`
+        self.known = set()
+        self.get = functools.lru_cache(maxsize=cache_size)(self._read)
+
+    @staticmethod
+    def key(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def put(self, data: bytes) -> str:
+        '''
+        store `data`, if not already stored, and return its key
+        '''
+        key = self.key(data)
+        if key in self.known:
+            return key
+        path = self.path(key)
+        try:
+            # an existing blob is now referenced by this run;
+            # refresh it, so `gc` treats it as new
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename; so concurrent writers and
+            # readers never see a partial blob
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp_path, path)
+        self.known.add(key)
+        return key
+
+    def _read(self, key: str) -> bytes:
+        with open(self.path(key), 'rb') as fp:
+            return fp.read()
+
+    def keys(self):
+        '''
+        generate keys of all stored blobs
+        '''
+        for prefix in os.listdir(self.root):
+            subdir = os.path.join(self.root, prefix)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if not name.endswith('.tmp'):
+                    yield name
+
+    def gc(self, referenced, min_age: float=3600.0) -> list:
+        '''
+        remove blobs whose key is not in `referenced`.
+        Blobs younger than `min_age` seconds are kept, since
+        the cassette of a running recording may not reference
+        them yet. A blob's age is since it was last `put`, by
+        the first `put` of its key in a process.
+        Returns removed keys.
+        '''
+        referenced = set(referenced)
+        cutoff = time.time() - min_age
+        removed = []
+        for key in list(self.keys()):
+            if key in referenced:
+                continue
+            path = self.path(key)
+            if os.path.getmtime(path) > cutoff:
+                continue
+            os.remove(path)
+            self.known.discard(key)
+            removed.append(key)
+        self.get.cache_clear()
+        return removed
+
+
+def referenced_keys(cassette_paths):
+    '''
+    generate blob keys referenced by records in `cassette_paths`
+    '''
+    from . import tape_utils as tu
+    for cassette_path in cassette_paths:
+        for record in tu.get_records(cassette_path):
+            key = tu.payload_key(record)
+            if key is not None:
+                yield key
+
+
+if __name__ == '__main__':
+    # garbage collect blobs unreferenced by any cassette, e.g.
+    # python -m ftracer.blob_store ./cassettes/blobs ./cassettes
+    import argparse
+    parser = argparse.ArgumentParser(description='remove unreferenced blobs')
+    parser.add_argument('blobs_dir')
+    parser.add_argument('cassettes_dir', help='all *.avro files in this dir are scanned')
+    parser.add_argument('--min-age', type=float, default=3600.0,
+                        help='keep blobs younger than this many seconds')
+    args = parser.parse_args()
+    cassettes = [os.path.join(args.cassettes_dir, name)
+                 for name in os.listdir(args.cassettes_dir) if name.endswith('.avro')]
+    store = BlobStore(args.blobs_dir)
+    removed = store.gc(referenced_keys(cassettes), min_age=args.min_age)
+    print(f'scanned {len(cassettes)} cassettes; removed {len(removed)} blobs')
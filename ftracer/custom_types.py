@@ -5,7 +5,6 @@ create an index on a module
 perhaps, this should be combined with classes/types
 from ast_indexer.py
 '''
-from ascii_tree import make_and_print_tree
 
 
 class UndefinedRelationship(Exception):
@@ -70,8 +69,11 @@ class Range:
 
 
 class TreeNode:
-    def __init__(self, val):
+    def __init__(self, val, key=None):
         self.val =  val
+        # Range of this node; None for the root
+        self.key = key
+        self.parent = None
         # sorted list of children as (Range, val)
         self.children = []
 
@@ -80,6 +82,7 @@ class TreeNode:
         return self.val
 
     def add_child(self, key, val, idx):
+        val.parent = self
         self.children.insert(idx, (key, val))
 
     def __repr__(self):
@@ -94,11 +97,19 @@ class NORangeTree:
 
     Requires:
         1) non-overlapping ranges
-        2) parent ranges are added before child ranges
-           NOTE: could be updated to handle out of order
-           updates, but unneeded as yet.
-        3) Children scopes are subsets of parents (not
-            necessarily proper subset)
+        2) Children scopes are subsets of parents (not
+            necessarily proper subset). Of two equal ranges,
+            the one added first is the parent.
+
+    Ranges can be added in any order; a range added after
+    ranges it encloses adopts them as children. When all
+    ranges are known upfront, `from_ranges` is faster.
+
+    Lookups go through a flat lineno -> innermost node array
+    (`lines`), so they don't search the tree. The array is
+    patched on `add_node` when the new node is a leaf,
+    i.e. the common case of adding parents before children,
+    and rebuilt on the next lookup otherwise.
 
     NOTE: currently `TreeNode` is dumb and `RangeTree`
     contains all the logic- sometimes reading
@@ -106,98 +117,217 @@ class NORangeTree:
     '''
     def __init__(self):
         self.root = TreeNode(None)
+        # lineno -> innermost TreeNode (None if outside all ranges);
+        # None when stale
+        self.lines = []
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        '''
+        build a tree from an iterable of (start, end, val)
+        in any order, with one sort and a stack sweep,
+        instead of an `add_node` per range.
+        '''
+        tree = cls()
+        # parents sort before their children; the sort is stable
+        # so of equal ranges the earlier one is the parent
+        ranges = sorted(ranges, key=lambda r: (r[0], -r[1]))
+        # enclosing nodes of the current range
+        stack = [tree.root]
+        for start, end, val in ranges:
+            while len(stack) > 1 and stack[-1].key.end < start:
+                stack.pop()
+            parent = stack[-1]
+            if parent.key is not None and parent.key.end < end:
+                # overlapping range
+                raise UndefinedRelationship
+            key = Range(start, end)
+            node = TreeNode(val, key)
+            node.parent = parent
+            parent.children.append((key, node))
+            stack.append(node)
+        tree.lines = None
+        return tree
 
     def _add_node(self, ancestor: TreeNode, key: Range, node: TreeNode):
         '''
         Add a new node. `node` has `key` and may
         be child of `ancestor`
         of it may be a deeper descendent.
-        If there is an existing child node(s) in this range
-        we recurse to find the correct parent.
-        Else, add it as a child of `ancestor`.
-        NB: this expect parents to be added before children
+        If there is an existing child node in this range
+        that encloses `key`, we recurse to find the correct parent.
+        Else, add it as a child of `ancestor`, adopting any
+        existing children that `key` encloses.
         '''
+        children = ancestor.children
+        # index of the first child that doesn't precede key
         left = 0
-        right = len(ancestor.children) - 1
-        idx = 0
-        while left <= right:
+        right = len(children)
+        while left < right:
             mid = (left + right) // 2
-            ch_key, ch_node = ancestor.children[mid]
-            # there are 3 possible states that ch_key and key
-            # can be in: encloses, precedes, or succeeds
-            if ch_key.encloses(key):
-                return self._add_node(ch_node, key, node)
-            elif ch_key.precedes(key):
-                # ch_key is before key; look to the right of mid
-                # but if this is the last idx before we terminate
-                # then that must be the index of insertion
+            if children[mid][0].precedes(key):
                 left = mid + 1
-                idx = mid + 1
-            elif ch_key.succeeds(key):
-                right = mid - 1
-                idx = mid - 1
             else:
+                right = mid
+        # children in [left, right) overlap key
+        right = left
+        while right < len(children) and not children[right][0].succeeds(key):
+            right += 1
+
+        if right - left == 1 and children[left][0].encloses(key):
+            return self._add_node(children[left][1], key, node)
+        adopted = children[left:right]
+        # check all before changing the tree; so it's
+        # unchanged if this raises
+        for ch_key, _ in adopted:
+            if not key.encloses(ch_key):
                 # overlapping range; misconstructed tree
-                # or out of order insertion, i.e. bigger scope
-                # after an enclosing scope
                 raise UndefinedRelationship
-
-        return ancestor.add_child(key, node, idx)
+        for ch_key, ch_node in adopted:
+            ch_node.parent = node
+        node.children = adopted
+        del children[left:right]
+        ancestor.add_child(key, node, left)
 
     def add_node(self, start_key: int, end_key: int, val):
         '''
         Add a new node.
         '''
         key = Range(start_key, end_key)
-        new_node = TreeNode(val)
+        new_node = TreeNode(val, key)
         self._add_node(self.root, key, new_node)
-
-    def get_scope_stack(self, lineno: int):
+        lines = self.lines
+        if lines is None:
+            return
+        if new_node.children:
+            # adopted nodes; cheaper to rebuild on the next lookup
+            self.lines = None
+            return
+        if len(lines) <= end_key:
+            lines.extend([None] * (end_key + 1 - len(lines)))
+        lines[start_key:end_key + 1] = [new_node] * (end_key + 1 - start_key)
+
+    def _build_lines(self):
         '''
-        Get the scope(s) at a specific `lineno`
+        fill the lineno -> innermost node array;
+        children overwrite their parents' lines
+        '''
+        size = 0
+        for key, _ in self.root.children:
+            size = max(size, key.end + 1)
+        lines = [None] * size
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for key, child in node.children:
+                lines[key.start:key.end + 1] = [child] * (key.end + 1 - key.start)
+                stack.append(child)
+        self.lines = lines
+        return lines
+
+    def innermost(self, lineno: int):
+        '''
+        Get the innermost node at `lineno`, or None
+        if `lineno` is outside all ranges
         '''
         if not self.root.children:
             # tree is empty- can't search
             raise EmptyTree
+        lines = self.lines
+        if lines is None:
+            lines = self._build_lines()
+        if 0 <= lineno < len(lines):
+            return lines[lineno]
+        return None
 
-        node = self.root
-        left = 0
-        right = len(node.children) - 1
-        # to simplify ops
-        lno_range = Range(lineno, lineno)
+    def get_scope_stack(self, lineno: int):
+        '''
+        Get the scope(s) at a specific `lineno`
+        '''
+        node = self.innermost(lineno)
         result = []
-        while left <= right:
-            mid = (left + right) // 2
-            ch_key, ch_node = node.children[mid]
-            # there are 3 possible states that ch_key and key
-            # can be in: encloses, precedes, or succeeds
-            if ch_key.encloses(lno_range):
-                # update result and loop over a smaller range
-                node = ch_node
-                left = 0
-                right = len(node.children) - 1
-                result.append(node)
-            elif ch_key.precedes(lno_range):
-                # ch_key is before key; look to the right of mid
-                left = mid + 1
-            elif ch_key.succeeds(lno_range):
-                right = mid - 1
-            else:
-                break
-
+        while node is not None and node is not self.root:
+            result.append(node)
+            node = node.parent
+        result.reverse()
         return Stack(result)
 
+    def values(self):
+        '''
+        generate values of all nodes, parents before children
+        '''
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for _, child in reversed(node.children):
+                yield child.value
+                stack.append(child)
+
+    def __getstate__(self):
+        # `lines` is derived; don't ship it when pickled
+        state = self.__dict__.copy()
+        state['lines'] = None
+        return state
+
 
 def get_children(n):
     return [v for k, v in n.children]
 
 
+def _bench_ranges(num_scopes):
+    '''
+    ranges shaped like a generated module: top-level
+    classes of 10 lines, each with 4 two-line methods
+    '''
+    ranges = []
+    lineno = 1
+    while len(ranges) < num_scopes:
+        ranges.append((lineno, lineno + 9, f'class{lineno}'))
+        for i in range(min(4, num_scopes - len(ranges))):
+            start = lineno + 1 + 2 * i
+            ranges.append((start, start + 1, f'method{start}'))
+        lineno += 10
+    return ranges
+
+
+def _bench(num_scopes):
+    import gc
+    import random
+    import time
+
+    ranges = _bench_ranges(num_scopes)
+    shuffled = ranges[:]
+    random.Random(0).shuffle(shuffled)
+    num_lines = ranges[-1][1]
+    timings = []
+    # like timeit; otherwise collections dominate at 100k nodes
+    gc.disable()
+
+    for label, order in (('add_node', ranges), ('add_node(shuffled)', shuffled)):
+        t0 = time.perf_counter()
+        rtree = NORangeTree()
+        for start, end, val in order:
+            rtree.add_node(start, end, val)
+        timings.append((label, time.perf_counter() - t0))
+
+    t0 = time.perf_counter()
+    rtree = NORangeTree.from_ranges(shuffled)
+    timings.append(('from_ranges(shuffled)', time.perf_counter() - t0))
+
+    rtree.innermost(1)
+    t0 = time.perf_counter()
+    for lineno in range(1, num_lines + 1):
+        rtree.get_scope_stack(lineno)
+    timings.append((f'get_scope_stack x{num_lines}', time.perf_counter() - t0))
+    gc.enable()
+
+    print(f'{num_scopes} scopes:')
+    for label, elapsed in timings:
+        print(f'  {label:<30}{elapsed * 1000:10.1f}ms')
+
+
 if __name__ == '__main__':
-    rtree = NORangeTree()
-    rtree.add_node(1, 10, 'global')
-    rtree.add_node(1, 3, 'funcfoo')
-    rtree.add_node(4, 4, 'funcbar')
-    # make_and_print_tree(rtree.root, get_val=lambda n: n.val, get_children=get_children)
-    # print(rtree.get_scope_stack(4))
-    import pickle
-    print(len(pickle.dumps(rtree)))
+    # usage: python -m ftracer.custom_types [num_scopes ...]
+    import sys
+    for num_scopes in map(int, sys.argv[1:] or (1000, 10000, 100000)):
+        _bench(num_scopes)
@@ -0,0 +1,181 @@
+'''
+streaming diff of two cassettes, e.g. the same flow
+recorded on an old and a new build.
+
+both cassettes are read in lockstep; events are aligned
+on (module_path, module_lno, event_type) and aligned events
+are compared by payload hash, without unpickling.
+when the event keys disagree, alignment is recovered within a
+bounded lookahead window; so memory is bounded by the window
+and time is linear in the cassette size.
+'''
+import os.path
+
+from collections import deque, namedtuple
+
+from . import tape_utils as tu
+
+# an event reduced to what is compared
+DiffEvent = namedtuple('DiffEvent', 'seq key payload')
+
+# where the cassettes first diverged; `kind` is one of
+# 'payload' (aligned events with different payloads),
+# 'deleted' (event only in a), 'inserted' (event only in b)
+Divergence = namedtuple('Divergence', 'kind event_a event_b')
+
+
+class DiffResult:
+    def __init__(self):
+        self.events_a = 0
+        self.events_b = 0
+        self.matched = 0
+        self.payload_mismatches = 0
+        self.only_in_a = 0
+        self.only_in_b = 0
+        self.first_divergence = None
+
+    @property
+    def identical(self):
+        return self.first_divergence is None
+
+    def diverged(self, kind, event_a, event_b):
+        if self.first_divergence is None:
+            self.first_divergence = Divergence(kind, event_a, event_b)
+
+    def __str__(self):
+        lines = [f'events: a={self.events_a} b={self.events_b}',
+                 f'matched: {self.matched}',
+                 f'payload mismatches: {self.payload_mismatches}',
+                 f'only in a: {self.only_in_a}',
+                 f'only in b: {self.only_in_b}']
+        if self.first_divergence is None:
+            lines.append('no divergence')
+        else:
+            kind, event_a, event_b = self.first_divergence
+            lines.append(f'first divergence ({kind}):')
+            lines.append(f'  a: {event_a}')
+            lines.append(f'  b: {event_b}')
+        return '\n'.join(lines)
+
+
+def _events(cassette_path, root=None):
+    '''
+    generate `DiffEvent`s of cassette; paths are made
+    relative to `root`, if given, so cassettes recorded
+    from different checkouts can be aligned
+    '''
+    seq = 0
+    for record in tu.get_records(cassette_path):
+        if record['event_type'] == 'CHECKPOINT':
+            continue
+        path = record['module_path']
+        if root is not None:
+            path = os.path.relpath(path, root)
+        payload = tu.payload_key(record)
+        if payload is None and 'object' in record['event_data']:
+            # cassette recorded before the blob store
+            from .blob_store import BlobStore
+            payload = BlobStore.key(record['event_data']['object'])
+        yield DiffEvent(seq, (path, record['module_lno'], record['event_type']), payload)
+        seq += 1
+
+
+def _fill(buffer, events, size):
+    while len(buffer) < size:
+        try:
+            buffer.append(next(events))
+        except StopIteration:
+            return
+
+
+def _realign(buf_a, buf_b):
+    '''
+    find (i, j) with the smallest i + j, such that
+    buf_a[i] and buf_b[j] have the same key; or None
+    '''
+    first_b = {}
+    for j, event in enumerate(buf_b):
+        first_b.setdefault(event.key, j)
+    best = None
+    for i, event in enumerate(buf_a):
+        if best is not None and i >= sum(best):
+            break
+        j = first_b.get(event.key)
+        if j is not None and (best is None or i + j < sum(best)):
+            best = (i, j)
+    return best
+
+
+def diff(path_a, path_b, window=1000, root_a=None, root_b=None) -> DiffResult:
+    '''
+    diff cassettes at `path_a` and `path_b`.
+
+    Args:
+        window: max events buffered per cassette to realign
+            after events were inserted or deleted; runs of
+            differences longer than this are reported as
+            unaligned events on both sides
+        root_a, root_b: make module paths relative to these
+    '''
+    result = DiffResult()
+    events_a = _events(path_a, root_a)
+    events_b = _events(path_b, root_b)
+    buf_a, buf_b = deque(), deque()
+
+    def skip(count_a, count_b):
+        for _ in range(count_a):
+            result.diverged('deleted', buf_a[0], buf_b[0] if buf_b else None)
+            buf_a.popleft()
+            result.only_in_a += 1
+        for _ in range(count_b):
+            result.diverged('inserted', buf_a[0] if buf_a else None, buf_b[0])
+            buf_b.popleft()
+            result.only_in_b += 1
+
+    while True:
+        _fill(buf_a, events_a, 1)
+        _fill(buf_b, events_b, 1)
+        if not buf_a or not buf_b:
+            # the rest of the longer cassette is unmatched
+            while buf_a or buf_b:
+                skip(len(buf_a), len(buf_b))
+                _fill(buf_a, events_a, window)
+                _fill(buf_b, events_b, window)
+            break
+
+        event_a, event_b = buf_a[0], buf_b[0]
+        if event_a.key == event_b.key:
+            if event_a.payload == event_b.payload:
+                result.matched += 1
+            else:
+                result.payload_mismatches += 1
+                result.diverged('payload', event_a, event_b)
+            buf_a.popleft()
+            buf_b.popleft()
+            continue
+
+        _fill(buf_a, events_a, window)
+        _fill(buf_b, events_b, window)
+        aligned = _realign(buf_a, buf_b)
+        if aligned is None:
+            skip(len(buf_a), len(buf_b))
+        else:
+            skip(*aligned)
+
+    # `_events` counts every event it yields
+    result.events_a = result.matched + result.payload_mismatches + result.only_in_a
+    result.events_b = result.matched + result.payload_mismatches + result.only_in_b
+    return result
+
+
+if __name__ == '__main__':
+    # e.g. python -m ftracer.diff old.avro new.avro
+    import argparse
+    parser = argparse.ArgumentParser(description='diff two cassettes')
+    parser.add_argument('cassette_a')
+    parser.add_argument('cassette_b')
+    parser.add_argument('--window', type=int, default=1000)
+    parser.add_argument('--root-a', help='make module paths of a relative to this dir')
+    parser.add_argument('--root-b', help='make module paths of b relative to this dir')
+    args = parser.parse_args()
+    print(diff(args.cassette_a, args.cassette_b, args.window, args.root_a, args.root_b))
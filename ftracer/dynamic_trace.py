@@ -1,16 +1,34 @@
 '''
 contains configurable tracing class
 '''
+import atexit
 import os
 import os.path
+import time
 
 from collections import namedtuple
 from typing import types
-from .utils import to_abspath, load_module
+from .utils import to_abspath, load_config
 from . import tape_utils as tu
 
 NameValuePair = namedtuple('NameValuePair', 'name value')
 
+# where a name is resolved from:
+#   LOCAL: fast local, cell or free variable; read from f_locals
+#   GLOBAL: f_globals, e.g. a `global` declared name
+#   NAMESPACE: unoptimized code (module, class body); read
+#       from f_locals, which is f_globals for a module
+# names are never read from f_builtins: every indexed name is
+# bound by the line; if it isn't bound yet, the builtin (or a
+# global of the same name) is not the value it was bound to
+LOCAL, GLOBAL, NAMESPACE = range(3)
+
+# where each name bound on a line is resolved from
+ResolutionPlan = namedtuple('ResolutionPlan', 'needs_locals steps')
+
+# same as `inspect.CO_OPTIMIZED`; inspect is slow to import
+CO_OPTIMIZED = 0x0001
+
 '''
 NOTE(caching):
 python caches certain objects, e.g.
@@ -35,22 +53,53 @@ class Tracer:
     implements configurable flow recording
     TODO: rename to recorder
     '''
-    def __init__(self, paths, tree_fn, cassette_path=None, config_path='./config.py'):
+    def __init__(self, paths, tree_fn, cassette_path=None, config_path='./config.py',
+                 stream_path=None):
         '''
         the tracer will need to track objects seens and events observed.
 
         Args:
             paths: a list of modules to trace
             tree_fn: callable, given module path returns `NodeIndexer`.
-                this enables lazy access
+                this enables lazy access. Unused (None) when
+                recording from instrumented code
             cassette_path: location where cassette is recorded
             config_path: location of config file (abs or rel)
+            stream_path: if set, events are also published live
+                on a unix socket at this path (see `stream`)
         '''
         self.paths = paths
         self.tree_fn = tree_fn
         # config object
-        self.config = load_module(to_abspath(config_path))
-        self.cassette = self.init_cassette(cassette_path)
+        self.config = load_config(to_abspath(config_path))
+        # payloads are shared by all cassettes
+        self.store = self.init_store()
+        cassette = self.init_cassette(cassette_path)
+        stats_fp = open(tu.block_stats_path(self.cassette_path), 'w')
+        self.cassette = tu.CassetteWriter(cassette, self.store, stats_fp)
+        # a checkpoint is written after `checkpoint_events` events
+        # or `checkpoint_seconds` seconds, whichever comes first.
+        # more frequent checkpoints make seeking faster but the
+        # cassette bigger
+        self.checkpoint_events = getattr(self.config, 'checkpoint_events', 10000)
+        self.checkpoint_seconds = getattr(self.config, 'checkpoint_seconds', 60.0)
+        self.checkpoint_fp = open(tu.checkpoint_index_path(self.cassette_path), 'w')
+        self.last_checkpoint = (0, time.monotonic())
+        # number of events recorded
+        self.num_events = 0
+        # id(int) -> blob key of tracked objects
+        self.object_keys = {}
+        # entries of `object_keys` (re)set since the last checkpoint
+        self.changed_keys = {}
+        # number of entries in delta checkpoints since the last full one
+        self.delta_size = 0
+        # buffered records must be written even if the
+        # tracer is never collected
+        atexit.register(self.close)
+        self.publisher = None
+        if stream_path is not None:
+            from .stream import EventPublisher
+            self.publisher = EventPublisher(stream_path)
         # id(int) -> object; objects being tracked/viewed
         # and to be serialized
         # we need to track it to avoid duplicate serialization
@@ -67,33 +116,140 @@ class Tracer:
         if cassette_path is None:
             cdir = to_abspath(self.config.cassettes_dir)
             cassette_path = os.path.join(cdir, 'A.avro')
+        self.cassette_path = cassette_path
         return open(cassette_path, 'wb')
 
+    def init_store(self):
+        '''
+        blob store for recorded payloads, at config `blobs_dir`,
+        defaulting to `<cassettes_dir>/blobs`
+        '''
+        from .blob_store import BlobStore
+        blobs_dir = getattr(self.config, 'blobs_dir', None)
+        if blobs_dir is None:
+            blobs_dir = os.path.join(self.config.cassettes_dir, 'blobs')
+        return BlobStore(to_abspath(blobs_dir))
+
     def __call__(self, frame, event, arg):
         return self.tracer(frame, event, arg)
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.cassette.fileptr.closed:
+            return
         self.cassette.close()
+        self.checkpoint_fp.close()
+        if self.publisher is not None:
+            self.publisher.close()
 
-    def _resolve_name(self, name, frame):
+    def _resolution_plan(self, code: types.CodeType, names) -> ResolutionPlan:
         '''
-        resolve name from the frame env vars.
-        does not handle non-local variables.
+        decide, from the static code object metadata,
+        where each of `names` should be looked up
         '''
-        if name in frame.f_locals:
-            return frame.f_locals[name]
-        elif name in frame.f_globals:
-            return frame.f_globals[name]
-        else:
-            raise ValueError(f'Unknown name: {name}')
+        if not code.co_flags & CO_OPTIMIZED:
+            # module and class bodies keep names in a dict
+            return ResolutionPlan(True, tuple((name, NAMESPACE) for name in names))
+        local_names = set(code.co_varnames + code.co_cellvars + code.co_freevars)
+        steps = tuple((name, LOCAL if name in local_names else GLOBAL) for name in names)
+        needs_locals = any(source == LOCAL for _, source in steps)
+        return ResolutionPlan(needs_locals, steps)
+
+    def _resolve_names(self, lno_names, frame):
+        '''
+        resolve all names bound on a line in one pass.
+        The frame locals are snapshot at most once, since on
+        CPython < 3.13 each `frame.f_locals` access syncs the
+        fast locals into a dict.
+        Unbound names, e.g. the line was not executed, are skipped.
+        The plan isn't cached; `record` resolves each line once.
+        '''
+        plan = self._resolution_plan(frame.f_code, lno_names.names)
+        f_locals = frame.f_locals if plan.needs_locals else None
+        f_globals = frame.f_globals
+        resolved = []
+        for name, source in plan.steps:
+            namespace = f_globals if source == GLOBAL else f_locals
+            if name in namespace:
+                resolved.append(NameValuePair(name, namespace[name]))
+        return resolved
 
     def record_event(self, filepath:str, lineno:int, event):
         '''
         record a `event` to file
         '''
         print(f'fpath={filepath} lineno={lineno} event={event}')
-        tu.append_record(self.cassette, filepath, lineno, event)
-        #self.cassette.write(f'{event}\n')
+        record = self.cassette.append(filepath, lineno, event)
+        self.num_events += 1
+        if isinstance(event, tu.ObjectCreated):
+            key = record['event_data']['object_hash']
+            self.object_keys[id(event.object)] = key
+            self.changed_keys[id(event.object)] = key
+        if self.publisher is not None:
+            self.publisher.publish(record)
+        self.maybe_checkpoint(filepath, lineno)
+
+    def maybe_checkpoint(self, filepath:str, lineno:int):
+        '''
+        write a checkpoint if enough events or
+        time passed since the last one
+        '''
+        last_seq, last_time = self.last_checkpoint
+        if self.num_events - last_seq < self.checkpoint_events:
+            now = time.monotonic()
+            if now - last_time < self.checkpoint_seconds:
+                return
+        else:
+            now = time.monotonic()
+        # a full checkpoint, once deltas since the last one add up
+        # to its size; so its cost is amortized over those events
+        full = self.delta_size + len(self.changed_keys) >= len(self.object_keys)
+        if full:
+            event = tu.Checkpoint(self.num_events, self.object_keys)
+            self.delta_size = 0
+        else:
+            event = tu.Checkpoint(self.num_events, self.changed_keys, full=False)
+            self.delta_size += len(self.changed_keys)
+        self.changed_keys = {}
+        # the checkpoint starts a new block; so players can seek to it
+        offset = self.cassette.flush()
+        self.cassette.append(filepath, lineno, event)
+        self.checkpoint_fp.write(f'{self.num_events} {offset} {int(full)}\n')
+        self.checkpoint_fp.flush()
+        self.last_checkpoint = (self.num_events, now)
+
+    def record_values(self, filepath:str, lineno:int, name_values):
+        '''
+        record an event for each value in `name_values`,
+        i.e. (name, value) pairs, that is not already tracked
+        '''
+        for name, value in name_values:
+            # python will cache certain objects
+            # which could cause issues with how the flow is recorded
+            # see NOTE(caching)
+            oid = id(value)
+            # first time seeing this object
+            if not self.objects.get(oid):
+                # TODO: handle new object created and name
+                # assigned separately
+                # event = f'Name {name} : {value}'
+                event = tu.ObjectCreated(value)
+                self.record_event(filepath, lineno, event)
+                self.objects[oid] = value
+            else:
+                pass
+
+    def record_bindings(self, filepath:str, lineno:int, bindings:dict):
+        '''
+        record names bound on `lineno`; called directly
+        from instrumented code (see `module_updater.RecordingInjector`)
+        instead of from the trace hook
+        '''
+        if (filepath, lineno) not in self.resolved:
+            self.record_values(filepath, lineno, bindings.items())
+            self.resolved.add((filepath, lineno))
 
     def record(self, filepath:str, lineno:int, frame:types.FrameType):
         '''
@@ -107,22 +263,10 @@ class Tracer:
         astree = self.tree_fn(filepath)
         lno_names = astree.prev_lno_names(lineno)
         if (filepath, lno_names.lineno) not in self.resolved:
-            for name in lno_names.names:
-                value = self._resolve_name(name, frame)
-                # python will cache certain objects
-                # which could cause issues with how the flow is recorded
-                # see NOTE(caching)
-                oid = id(value)
-                # first time seeing this object
-                if not self.objects.get(oid):
-                    # TODO: handle new object created and name
-                    # assigned separately
-                    # event = f'Name {name} : {value}'
-                    event = tu.ObjectCreated(value)
-                    self.record_event(filepath, lineno, event)
-                    self.objects[oid] = value
-                else:
-                    pass
+            # recorded at the line that bound the names, like
+            # instrumented code does; not the line executing now
+            self.record_values(filepath, lno_names.lineno,
+                               self._resolve_names(lno_names, frame))
             # to avoid duplicate resolves
             self.resolved.add((filepath, lno_names.lineno))
 
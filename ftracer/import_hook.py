@@ -0,0 +1,81 @@
+'''
+import hook that instruments modules as they
+are imported; so nothing is rewritten on disk
+'''
+import fnmatch
+import importlib.machinery
+import os.path
+import sys
+
+from .module_updater import compile_instrumented
+from .utils import realpath
+
+
+class InstrumentingLoader(importlib.machinery.SourceFileLoader):
+    '''
+    loads a source module instrumented by
+    `module_updater.RecordingInjector`
+    '''
+    def get_code(self, fullname):
+        # bypass the regular bytecode cache; it holds
+        # uninstrumented code. `compile_instrumented`
+        # keeps its own cache keyed by source hash
+        source_path = self.get_filename(fullname)
+        return compile_instrumented(source_path, self.get_data(source_path))
+
+
+class InstrumentingFinder:
+    '''
+    meta path finder that hands configured modules
+    to `InstrumentingLoader`; all other imports fall
+    through to the regular finders.
+    NB: doesn't subclass `importlib.abc.MetaPathFinder`;
+    importing importlib.abc is slow
+    '''
+    def __init__(self, patterns=(), paths=()):
+        '''
+        Args:
+            patterns: fnmatch patterns of module names
+                to instrument, e.g. `mypkg.*`
+            paths: paths of modules to instrument
+        '''
+        self.patterns = list(patterns)
+        self.paths = {realpath(path) for path in paths}
+        # unqualified module names `paths` could be imported as;
+        # lets most imports skip the path lookup below
+        self.stems = {self._stem(path) for path in self.paths}
+
+    @staticmethod
+    def _stem(path):
+        head, tail = os.path.split(path)
+        if tail == '__init__.py':
+            return os.path.basename(head)
+        return os.path.splitext(tail)[0]
+
+    def find_spec(self, fullname, path, target=None):
+        matches_name = any(fnmatch.fnmatchcase(fullname, pattern) for pattern in self.patterns)
+        if not matches_name and fullname.rpartition('.')[2] not in self.stems:
+            return None
+        spec = importlib.machinery.PathFinder.find_spec(fullname, path)
+        if spec is None or not isinstance(spec.loader, importlib.machinery.SourceFileLoader):
+            # e.g. namespace packages, extension modules
+            return None
+        if not matches_name and realpath(spec.origin) not in self.paths:
+            return None
+        spec.loader = InstrumentingLoader(fullname, spec.origin)
+        return spec
+
+
+def install_import_hook(patterns=(), paths=()) -> InstrumentingFinder:
+    '''
+    instrument modules matching `patterns` or `paths`
+    when they are imported (see `InstrumentingFinder`).
+    Modules already imported are not affected.
+    '''
+    finder = InstrumentingFinder(patterns, paths)
+    sys.meta_path.insert(0, finder)
+    return finder
+
+
+def uninstall_import_hook(finder: InstrumentingFinder):
+    sys.meta_path.remove(finder)
@@ -2,23 +2,61 @@
 update module
 '''
 import ast
-import astor
+import importlib.util
+import marshal
+import os
+import os.path
+import sys
+import types
 
-from .utils import module2ast, with_suffix, quoted
+from .ast_indexer import unwrap_target
+from .utils import module2ast, with_suffix
+
+# injection modes; see `TracingInjector`
+SETTRACE = 'settrace'
+INSTRUMENT = 'instrument'
+
+# name instrumented modules import ftracer as
+RECORDER_ALIAS = '__ftracer__'
+
+# bump when `RecordingInjector` output changes,
+# to invalidate cached instrumented code
+INSTRUMENTATION_VERSION = b'1'
+
+
+def _prelude_index(body) -> int:
+    '''
+    index in module `body` that injected statements go at:
+    after the docstring and `from __future__` imports, which
+    must come first
+    '''
+    idx = 0
+    if body and isinstance(body[0], ast.Expr) and \
+            isinstance(body[0].value, ast.Constant) and \
+            isinstance(body[0].value.value, str):
+        idx = 1
+    while idx < len(body) and isinstance(body[idx], ast.ImportFrom) \
+            and body[idx].module == '__future__':
+        idx += 1
+    return idx
 
 
 class TracingInjector(ast.NodeTransformer):
     '''
     injects tracing code into module
     '''
-    def __init__(self, target_mpath, run_mpath):
+    def __init__(self, target_mpath, run_mpath, mode=SETTRACE):
         '''
         Args:
             target_mpath: abs path of module to be analyzed
             run_mpath: module triggering the flow
+            mode: SETTRACE, record via a `sys.settrace` hook; or
+                INSTRUMENT, record from calls compiled into the
+                runner and target (see `RecordingInjector`)
         '''
         self.target_mpath = target_mpath
         self.run_mpath = run_mpath
+        self.mode = mode
         super().__init__()
 
     def visit_Module(self, node):
@@ -26,28 +64,229 @@ class TracingInjector(ast.NodeTransformer):
         Inject tracing logic on top module
         '''
         self.generic_visit(node)
-        # list of statements/expr to be prepended to body
+        if self.mode == INSTRUMENT:
+            RecordingInjector(self.run_mpath).visit(node)
+        # list of statements/expr to be inserted at the top of body
         prebody = []
         # "import ftracer"
         line = ast.Import([ast.alias('ftracer', None)])
         prebody.append(line)
-        # ftrace.set_trace
-        attr = ast.Attribute(ast.Name('ftracer'), 'set_trace', ast.Load())
-        # ftrace.set_trace(<target>,<run>)
+        if self.mode == INSTRUMENT:
+            prebody.extend(self._instrument_prelude())
+        else:
+            # ftrace.set_trace
+            attr = ast.Attribute(ast.Name('ftracer', ast.Load()), 'set_trace', ast.Load())
+            # ftrace.set_trace(<target>,<run>)
+            call = ast.Call(func=attr,
+                            args=[ast.Constant(self.target_mpath),
+                                    ast.Constant(self.run_mpath)],
+                            keywords=[])
+            # ftrace.set_trace(...)
+            line = ast.Expr(call)
+            prebody.append(line)
+
+        idx = _prelude_index(node.body)
+        node.body[idx:idx] = prebody
+        ast.fix_missing_locations(node)
+        return node
+
+    def _instrument_prelude(self):
+        '''
+        statements that start the recorder and
+        instrument the target module when it is imported
+        '''
+        paths = [ast.Constant(self.target_mpath), ast.Constant(self.run_mpath)]
+        # ftracer.set_recorder(<target>, <run>)
+        attr = ast.Attribute(ast.Name('ftracer', ast.Load()), 'set_recorder', ast.Load())
+        set_recorder = ast.Expr(ast.Call(func=attr, args=paths, keywords=[]))
+        # ftracer.install_import_hook(paths=[<target>])
+        attr = ast.Attribute(ast.Name('ftracer', ast.Load()), 'install_import_hook', ast.Load())
+        target = ast.List([ast.Constant(self.target_mpath)], ast.Load())
+        hook = ast.Expr(ast.Call(func=attr, args=[], keywords=[ast.keyword('paths', target)]))
+        return [set_recorder, hook]
+
+
+class RecordingInjector(ast.NodeTransformer):
+    '''
+    instruments a module so that each statement binding
+    names, that `NodeIndexer` would index with a line number,
+    is followed by a direct call to the recorder with the bound
+    values, i.e.
+        x, y = f()
+    becomes
+        x, y = f()
+        __ftracer__.record_bindings(<path>, <lineno>, {'x': x, 'y': y})
+
+    for/with/except targets are recorded at the start of their body.
+    Attribute and subscript targets, and walrus/comprehension
+    bindings, which are expressions, are not recorded.
+    '''
+    def __init__(self, module_path):
+        self.module_path = module_path
+        super().__init__()
+
+    def visit_Module(self, node):
+        self.generic_visit(node)
+        # "import ftracer as __ftracer__"
+        line = ast.Import([ast.alias('ftracer', RECORDER_ALIAS)])
+        node.body.insert(_prelude_index(node.body), line)
+        ast.fix_missing_locations(node)
+        return node
+
+    def generic_visit(self, node):
+        super().generic_visit(node)
+        # instrument every statement list, e.g. body, orelse
+        for field in ('body', 'orelse', 'finalbody'):
+            stmts = getattr(node, field, None)
+            if isinstance(stmts, list) and stmts and isinstance(stmts[0], ast.stmt):
+                setattr(node, field, self._instrument_stmts(stmts))
+        if isinstance(node, (ast.For, ast.AsyncFor)):
+            self._prepend_record(node, [node.target])
+        elif isinstance(node, (ast.With, ast.AsyncWith)):
+            self._prepend_record(node, [item.optional_vars for item in node.items
+                                        if item.optional_vars is not None])
+        elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+            self._prepend_record(node, [ast.Name(node.name, ast.Store())])
+        return node
+
+    def _instrument_stmts(self, stmts):
+        result = []
+        for stmt in stmts:
+            result.append(stmt)
+            if isinstance(stmt, ast.Assign):
+                targets = stmt.targets
+            elif isinstance(stmt, ast.AugAssign):
+                targets = [stmt.target]
+            elif isinstance(stmt, ast.AnnAssign) and stmt.value is not None:
+                targets = [stmt.target]
+            else:
+                continue
+            call = self._record_call(stmt, targets)
+            if call is not None:
+                result.append(call)
+        return result
+
+    def _prepend_record(self, node, targets):
+        call = self._record_call(node, targets)
+        if call is not None:
+            node.body.insert(0, call)
+
+    def _record_call(self, node, targets):
+        '''
+        `__ftracer__.record_bindings(<path>, <lineno>, {<name>: <name>, ..})`
+        for names bound by `targets` of `node`; None if no names are bound
+        '''
+        names = []
+        for target in targets:
+            for part_target in unwrap_target(target):
+                if isinstance(part_target, ast.Name) and part_target.id not in names:
+                    names.append(part_target.id)
+        if not names:
+            return None
+        bindings = ast.Dict(keys=[ast.Constant(name) for name in names],
+                            values=[ast.Name(name, ast.Load()) for name in names])
+        attr = ast.Attribute(ast.Name(RECORDER_ALIAS, ast.Load()), 'record_bindings', ast.Load())
         call = ast.Call(func=attr,
-                        args=[ast.Name(quoted(self.target_mpath)),
-                                ast.Name(quoted(self.run_mpath))],
+                        args=[ast.Constant(self.module_path), ast.Constant(node.lineno), bindings],
                         keywords=[])
-        # ftrace.set_trace(...)
         line = ast.Expr(call)
-        prebody.append(line)
+        # attribute the call to the binding line
+        for child in ast.walk(line):
+            ast.copy_location(child, node)
+        return line
 
-        node.body = prebody + node.body
-        ast.fix_missing_locations(node)
-        return node
+
+def _instrumented_cache_key(module_path: str, source: bytes) -> bytes:
+    '''
+    key of the instrumented code of `source`; the path is
+    part of it, since it is compiled into the code, both as
+    `co_filename` and as the path events are recorded with
+    '''
+    import hashlib
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in (importlib.util.MAGIC_NUMBER, INSTRUMENTATION_VERSION,
+                 os.fsencode(module_path), source):
+        # length prefixed; so parts can't run into each other
+        hasher.update(len(part).to_bytes(8, 'little'))
+        hasher.update(part)
+    return hasher.digest()
+
+
+def _instrumented_cache_path(module_path: str) -> str:
+    '''
+    cached code lives next to the module, like `.pyc` files:
+    one file per module, that starts with the key of the
+    source it was compiled from (see `compile_instrumented`)
+    '''
+    head, tail = os.path.split(module_path)
+    stem, _ = os.path.splitext(tail)
+    return os.path.join(head, '__pycache__', f'{stem}.ftracer.pyc')
+
+
+def _remove_legacy_cache(cache_path: str):
+    '''
+    remove `<stem>.ftracer-<hash>.pyc` files, i.e. caches
+    keyed by file name, written by earlier versions
+    '''
+    cache_dir, name = os.path.split(cache_path)
+    prefix = name[:-len('.pyc')] + '-'
+    for sibling in os.listdir(cache_dir):
+        if sibling.startswith(prefix) and sibling.endswith('.pyc'):
+            try:
+                os.remove(os.path.join(cache_dir, sibling))
+            except OSError:
+                pass
+
+
+# cache key -> code object; see `compile_instrumented`
+_code_cache = {}
 
 
-def rewrite_module(running_mpath: str, target_mpath: str, suffix: str='instrum'):
+def compile_instrumented(module_path: str, source: bytes=None):
+    '''
+    compile module at `module_path`, instrumented with
+    `RecordingInjector`, into a code object.
+    Compiled code is cached, in memory and on disk, keyed by
+    the source hash and path; so unchanged modules aren't
+    re-transformed. The disk cache is a single file per
+    module, laid out as: magic number, key, marshalled code.
+    '''
+    if source is None:
+        with open(module_path, 'rb') as fp:
+            source = fp.read()
+    key = _instrumented_cache_key(module_path, source)
+    code = _code_cache.get(key)
+    if code is not None:
+        return code
+    cache_path = _instrumented_cache_path(module_path)
+    header = importlib.util.MAGIC_NUMBER + key
+    try:
+        with open(cache_path, 'rb') as fp:
+            if fp.read(len(header)) == header:
+                code = _code_cache[key] = marshal.load(fp)
+                return code
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    tree = ast.parse(source, filename=module_path)
+    RecordingInjector(module_path).visit(tree)
+    code = _code_cache[key] = compile(tree, module_path, 'exec', dont_inherit=True)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # write then rename; so readers never see a partial file
+        tmp_path = f'{cache_path}.{os.getpid()}'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(header)
+            marshal.dump(code, fp)
+        os.replace(tmp_path, cache_path)
+        _remove_legacy_cache(cache_path)
+    except OSError:
+        # caching is best effort, e.g. read-only dirs
+        pass
+    return code
+
+
+def rewrite_module(running_mpath: str, target_mpath: str, suffix: str='instrum', mode=SETTRACE):
     '''
     Rewrite the module (python file) file
     with instrumentation code
@@ -58,17 +297,52 @@ def rewrite_module(running_mpath: str, target_mpath: str, suffix: str='instrum')
         running_mpath: path of module that will be rewritten and run
         target_mpath: path of module to analyze
         suffix: rewrite foo.py as foo-<suffix>.py
+        mode: see `TracingInjector`
     Returns:
         str (path to updated file)
     '''
+    # only needed here; slow to import
+    import astor
     # update the runnner
     module = module2ast(running_mpath)
     # updated module path
     new_mpath = with_suffix(running_mpath, suffix)
     # module object updated in-place
-    TracingInjector(target_mpath, new_mpath).visit(module)
+    TracingInjector(target_mpath, new_mpath, mode=mode).visit(module)
     # write modified module
     with open(new_mpath, 'w') as fp:
         fp.write(astor.to_source(module))
 
     return new_mpath
+
+
+def run_module(running_mpath: str, target_mpath: str, mode=SETTRACE) -> dict:
+    '''
+    Instrument the runner in memory and run it as `__main__`.
+    Unlike `rewrite_module`, no file is written and the
+    transformed ast is compiled directly.
+
+    Args:
+        running_mpath: path of module to instrument and run
+        target_mpath: path of module to analyze
+        mode: see `TracingInjector`
+    Returns:
+        dict (globals of the finished run)
+    '''
+    module = module2ast(running_mpath)
+    TracingInjector(target_mpath, running_mpath, mode=mode).visit(module)
+    code = compile(module, running_mpath, 'exec', dont_inherit=True)
+
+    main = types.ModuleType('__main__')
+    main.__file__ = running_mpath
+    main.__builtins__ = __builtins__
+    saved_main = sys.modules.get('__main__')
+    sys.modules['__main__'] = main
+    # like `python <runner>`, imports resolve relative to the runner
+    sys.path.insert(0, os.path.dirname(running_mpath))
+    try:
+        exec(code, main.__dict__)
+    finally:
+        sys.path.remove(os.path.dirname(running_mpath))
+        sys.modules['__main__'] = saved_main
+    return main.__dict__
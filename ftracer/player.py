@@ -1,6 +1,8 @@
 '''
 API for playing the cassette
 '''
+import bisect
+
 from . import tape_utils as tu
 
 
@@ -9,11 +11,25 @@ class TapePlayer:
     Play a flow cassette.
     Interface broadly resembles pdb.
     '''
-    def __init__(self, cassette_path, step=True):
+    def __init__(self, cassette_path, step=True, tail=False, modules=None, lines=None,
+                 event_types=None, seq_range=None):
         '''
         step: whether to step through execution i.e. prompt
+        tail: whether `cassette_path` is the socket of a running
+            recording (see `set_trace(stream_path=...)`); events
+            are then played live as they are recorded
+        modules, lines, event_types, seq_range: only play
+            matching events; see `tape_utils.get_records`
         '''
-        self.cassette = tu.get_records(cassette_path)
+        self.cassette_path = cassette_path
+        self.tail = tail
+        filters = dict(modules=modules, lines=lines, event_types=event_types,
+                       seq_range=seq_range)
+        if tail:
+            from .stream import subscribe
+            self.cassette = tu.filter_records(subscribe(cassette_path), **filters)
+        else:
+            self.cassette = tu.get_records(cassette_path, **filters)
         self.step = step
 
     def play(self):
@@ -21,9 +37,73 @@ class TapePlayer:
         step through cassette
         '''
         for record in self.cassette:
+            if record['event_type'] == 'CHECKPOINT':
+                continue
             print(record)
             # prompt user to step
             if self.step:
                 input('step? ')
 
         print('finished')
+
+    def state_at(self, n: int) -> dict:
+        '''
+        tracked objects after the first `n` events, as a
+        dict of object id -> blob key (see `tape_utils.load_object`).
+        Starts from the closest full checkpoint at or before `n`,
+        applies the delta checkpoints after it, up to `n`, and
+        replays the events after those, rather than replaying
+        from the first record.
+        '''
+        if self.tail:
+            raise ValueError('state_at needs a recorded cassette')
+        index = tu.checkpoint_index(self.cassette_path)
+        pos = bisect.bisect_right(index, (n, float('inf'))) - 1
+        while pos >= 0:
+            full_pos = pos
+            while not index[full_pos][2]:
+                full_pos -= 1
+            state = self._checkpoint_keys(*index[full_pos][:2])
+            if state is None:
+                # the checkpoint is indexed but its record is not
+                # written yet, e.g. the cassette is still recording
+                pos = full_pos - 1
+                continue
+            seq, offset, _ = index[full_pos]
+            for delta_seq, delta_offset, _ in index[full_pos + 1:pos + 1]:
+                delta = self._checkpoint_keys(delta_seq, delta_offset)
+                if delta is None:
+                    break
+                state.update(delta)
+                seq, offset = delta_seq, delta_offset
+            return self._replay(n, seq, offset, state)
+        return self._replay(n, 0, None, {})
+
+    def _checkpoint_keys(self, seq: int, offset: int):
+        '''
+        dict of object id -> blob key of the checkpoint after
+        `seq` events at `offset`; None if it isn't there
+        '''
+        record = next(tu.get_records(self.cassette_path, offset), None)
+        if (record is None or record['event_type'] != 'CHECKPOINT'
+                or record['event_data']['seq'] != seq):
+            return None
+        data = record['event_data']
+        return dict(zip(data['object_ids'], data['object_hashes']))
+
+    def _replay(self, n: int, seq: int, offset, state: dict) -> dict:
+        '''
+        update `state`, the state after `seq` events, by
+        replaying events up to `n` from the block at `offset`,
+        or from the first record if `offset` is None
+        '''
+        for record in tu.get_records(self.cassette_path, offset):
+            if record['event_type'] == 'CHECKPOINT':
+                continue
+            if seq >= n:
+                break
+            data = record['event_data']
+            if record['event_type'] == 'OBJECT_CREATED':
+                state[data['object_id']] = data['object_hash']
+            seq += 1
+        return state
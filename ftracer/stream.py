@@ -0,0 +1,225 @@
+'''
+live streaming of recorded events over a unix domain socket.
+
+frame layout (network byte order):
+    length: uint32, size of the rest of the frame
+    event type: uint8, index into the `event_enum` symbols
+    lineno: int32
+    path length: uint16
+    path: utf-8 bytes
+    payload: the rest; the ascii blob key of the object
+
+the publisher never blocks the traced program: each subscriber
+has a bounded buffer of unsent frames; a frame that does not fit
+is dropped for that subscriber. The next frame that fits is
+preceded by a DROPPED marker frame: event type `DROPPED_CODE`,
+lineno 0, no path, and the number of dropped frames as payload.
+'''
+import os
+import select
+import socket
+import struct
+import time
+
+from . import tape_utils as tu
+
+LENGTH = struct.Struct('!I')
+HEADER = struct.Struct('!BiH')
+
+# event type symbol <-> frame code
+EVENT_TYPES = tu.schema[0]['symbols']
+EVENT_CODES = {symbol: code for code, symbol in enumerate(EVENT_TYPES)}
+# marker of frames dropped for a slow subscriber; not an `event_enum` symbol
+DROPPED = 'DROPPED'
+DROPPED_CODE = 255
+
+
+def encode_frame(record) -> bytes:
+    '''
+    encode a record, as written to the cassette (see `tape_utils.CassetteWriter.append`)
+    '''
+    path = record['module_path'].encode()
+    payload = (tu.payload_key(record) or '').encode()
+    return _frame(EVENT_CODES[record['event_type']], record['module_lno'], path, payload)
+
+
+def encode_dropped(count: int) -> bytes:
+    '''
+    encode a marker of `count` dropped frames
+    '''
+    return _frame(DROPPED_CODE, 0, b'', str(count).encode())
+
+
+def _frame(code, lineno, path, payload) -> bytes:
+    header = HEADER.pack(code, lineno, len(path))
+    return LENGTH.pack(len(header) + len(path) + len(payload)) + header + path + payload
+
+
+def decode_frame(body: bytes) -> dict:
+    '''
+    decode a frame, without the length prefix,
+    into a record like those from `tape_utils.get_records`.
+    A DROPPED marker is decoded as
+    `{'event_type': DROPPED, 'event_data': {'dropped': count}, ...}`
+    '''
+    code, lineno, path_len = HEADER.unpack_from(body)
+    start = HEADER.size
+    path = body[start:start + path_len].decode()
+    payload = body[start + path_len:].decode()
+    if code == DROPPED_CODE:
+        return {'module_path': path,
+                'module_lno': lineno,
+                'event_type': DROPPED,
+                'event_data': {'dropped': int(payload)}}
+    return {'module_path': path,
+            'module_lno': lineno,
+            'event_type': EVENT_TYPES[code],
+            'event_data': {'object_hash': payload}}
+
+
+class _Subscriber:
+    def __init__(self, sock):
+        self.sock = sock
+        # encoded frames not yet sent
+        self.pending = bytearray()
+        # number of frames dropped since the subscriber was slow
+        self.dropped = 0
+        # number of dropped frames not yet reported in a marker
+        self.unreported = 0
+
+
+class EventPublisher:
+    '''
+    publishes events to any number of subscribers
+    connected to the unix socket at `socket_path`
+    '''
+    def __init__(self, socket_path: str, max_pending: int=1 << 20):
+        '''
+        Args:
+            socket_path: path of the unix socket to listen on
+            max_pending: max bytes buffered per subscriber;
+                frames beyond this are dropped for that subscriber
+        '''
+        self.socket_path = socket_path
+        self.max_pending = max_pending
+        if os.path.exists(socket_path):
+            # stale socket of a previous run
+            os.unlink(socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.subscribers = []
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except BlockingIOError:
+                return
+            sock.setblocking(False)
+            self.subscribers.append(_Subscriber(sock))
+
+    def publish(self, record):
+        '''
+        send `record` to every subscriber, without blocking
+        '''
+        self._accept()
+        if not self.subscribers:
+            return
+        frame = encode_frame(record)
+        for subscriber in list(self.subscribers):
+            self._enqueue(subscriber, frame)
+            self._flush(subscriber)
+
+    def _enqueue(self, subscriber, frame):
+        if subscriber.unreported:
+            frame = encode_dropped(subscriber.unreported) + frame
+        if len(subscriber.pending) + len(frame) > self.max_pending:
+            subscriber.dropped += 1
+            subscriber.unreported += 1
+        else:
+            subscriber.pending += frame
+            subscriber.unreported = 0
+
+    def _flush(self, subscriber):
+        try:
+            sent = subscriber.sock.send(subscriber.pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            # e.g. subscriber went away
+            self.subscribers.remove(subscriber)
+            subscriber.sock.close()
+            return
+        del subscriber.pending[:sent]
+
+    def _drain(self, timeout: float):
+        '''
+        send pending frames, and markers of unreported drops,
+        for at most `timeout` seconds in total
+        '''
+        deadline = time.monotonic() + timeout
+        for subscriber in list(self.subscribers):
+            while subscriber in self.subscribers:
+                if subscriber.unreported:
+                    marker = encode_dropped(subscriber.unreported)
+                    if len(subscriber.pending) + len(marker) <= self.max_pending:
+                        subscriber.pending += marker
+                        subscriber.unreported = 0
+                if not subscriber.pending:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                _, writable, _ = select.select([], [subscriber.sock], [], remaining)
+                if writable:
+                    self._flush(subscriber)
+
+    def close(self, timeout: float=1.0):
+        '''
+        send pending frames, waiting at most `timeout`
+        seconds for slow subscribers, then disconnect them
+        '''
+        self._drain(timeout)
+        for subscriber in self.subscribers:
+            subscriber.sock.close()
+            if subscriber.dropped or subscriber.pending:
+                print(f'stream subscriber dropped {subscriber.dropped} frames; '
+                      f'{len(subscriber.pending)} bytes unsent at close')
+        self.subscribers = []
+        self.server.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def subscribe(socket_path: str, bufsize: int=1 << 16):
+    '''
+    connect to the publisher at `socket_path` and return
+    a generator of records published from now on,
+    until the publisher closes
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    return _read_records(sock, bufsize)
+
+
+def _read_records(sock, bufsize):
+    buffer = bytearray()
+    try:
+        while True:
+            chunk = sock.recv(bufsize)
+            if not chunk:
+                return
+            buffer += chunk
+            offset = 0
+            while len(buffer) - offset >= LENGTH.size:
+                (length,) = LENGTH.unpack_from(buffer, offset)
+                end = offset + LENGTH.size + length
+                if end > len(buffer):
+                    break
+                yield decode_frame(bytes(buffer[offset + LENGTH.size:end]))
+                offset = end
+            del buffer[:offset]
+    finally:
+        sock.close()
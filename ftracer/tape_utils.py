@@ -1,9 +1,11 @@
 '''
 utils for interacting with avro files
+
+NB: dill and fastavro are imported where used; importing
+them costs more than the rest of ftracer, and the injected
+runner imports ftracer on every run.
 '''
-import dill
 import functools
-from fastavro import writer, reader, parse_schema
 
 
 '''
@@ -16,20 +18,57 @@ the different events are:
         a line may include both obj_created and name_assigned
         but the obj_created happens first
     attr_assigned: an object's attribute was (re)set
+    checkpoint: not an event of the flow; summarizes the
+        objects tracked so far, so players can start from it
+        instead of the first record. each checkpoint starts
+        a new avro block, and its offset is listed in the
+        cassette's checkpoint index (see `checkpoint_index`).
+        a full checkpoint lists all tracked objects; a delta
+        checkpoint only those (re)tracked since the previous
+        checkpoint. the recorder writes a full one once the
+        deltas since the last full one add up to its size;
+        so checkpoints grow the cassette linearly with the
+        number of events, and replaying deltas on top of a full
+        checkpoint reads no more entries than a full one.
+
+the recorder also writes statistics of the events in each
+avro block (see `BlockStats`); so filtered reads skip whole
+blocks without decoding them.
+
+`module_lno` of an event is the line that bound the name(s)
+of the object, whether recorded by the trace hook or by
+instrumented code; so cassettes of both modes line up.
+
+object payloads are not stored inline; each pickled
+object is put in a `BlobStore` and the event references
+its key (`object_hash`).
 '''
 
 schema = [
 {
     'name': 'event_enum',
     'type': 'enum',
-    'symbols': ['OBJECT_CREATED', 'NAME_ASSIGNED', 'ATTR_ASSIGNED']
+    'symbols': ['OBJECT_CREATED', 'NAME_ASSIGNED', 'ATTR_ASSIGNED', 'CHECKPOINT']
 },
 {
     'name': 'object_created',
     'doc': 'object creation event',
     'type': 'record',
     'fields': [
-        {'name': 'object', 'type': 'bytes'},
+        {'name': 'object_hash', 'type': 'string'},
+        {'name': 'object_id', 'type': 'long'},
+    ]
+},
+{
+    'name': 'checkpoint',
+    'doc': 'tracked objects after `seq` events, as parallel arrays; '
+           'all of them if `full`, else those (re)tracked since the previous checkpoint',
+    'type': 'record',
+    'fields': [
+        {'name': 'seq', 'type': 'long'},
+        {'name': 'object_ids', 'type': {'type': 'array', 'items': 'long'}},
+        {'name': 'object_hashes', 'type': {'type': 'array', 'items': 'string'}},
+        {'name': 'full', 'type': 'boolean', 'default': True},
     ]
 },
 {
@@ -38,29 +77,76 @@ schema = [
     'type': 'record',
     'fields': [
         {'name': 'module_path', 'type': 'string'},
-        {'name': 'module_lno', 'type': 'int'},
+        {'name': 'module_lno', 'type': 'int',
+         'doc': 'line that bound the name(s) of the object'},
         {'name': 'event_type', 'type': 'event_enum'},
-        {'name': 'event_data', 'type': ['object_created']}
+        {'name': 'event_data', 'type': ['object_created', 'checkpoint']}
     ]
 }]
 
-EVENT_SCHEMA = parse_schema(schema)
+
+@functools.lru_cache(maxsize=None)
+def event_schema():
+    'parsed `schema`; parsed on first use'
+    from fastavro import parse_schema
+    return parse_schema(schema)
+
 
 class Event:
     '''abstract base class representing
     events to record. this is provided
     to facilitate writing to avro
     '''
-    def to_dict(self):
-        'serialized representation based on schema'
+    def to_dict(self, store):
+        '''serialized representation based on schema;
+        payloads are put in `store` (BlobStore)'''
         raise NotImplementedError
 
 class ObjectCreated(Event):
     def __init__(self, object):
         self.object = object
 
-    def to_dict(self):
-        return {'object': dill.dumps(self.object)}
+    def to_dict(self, store):
+        import dill
+        return {'object_hash': store.put(dill.dumps(self.object)),
+                'object_id': id(self.object)}
+
+class Checkpoint(Event):
+    def __init__(self, seq, object_keys, full=True):
+        '''
+        seq: number of events recorded before the checkpoint
+        object_keys: dict of object id -> blob key of all tracked
+            objects if `full`, else of those (re)tracked since
+            the previous checkpoint
+        '''
+        self.seq = seq
+        self.object_keys = object_keys
+        self.full = full
+
+    def to_dict(self, store):
+        return {'seq': self.seq,
+                'object_ids': list(self.object_keys.keys()),
+                'object_hashes': list(self.object_keys.values()),
+                'full': self.full}
+
+
+def payload_key(record):
+    '''
+    blob key referenced by `record`, or None; e.g.
+    cassettes recorded before the blob store have inline payloads
+    '''
+    return record['event_data'].get('object_hash')
+
+
+def load_object(record, store):
+    '''
+    unpickle the object of an OBJECT_CREATED `record`
+    '''
+    import dill
+    data = record['event_data']
+    if 'object_hash' in data:
+        return dill.loads(store.get(data['object_hash']))
+    return dill.loads(data['object'])
 
 
 @functools.lru_cache
@@ -79,31 +165,299 @@ def to_symbol(name):
     return ''.join(result)
 
 
-def append_record(fileptr, path: str, lineno: int, event: Event):
+class BlockStats:
+    '''
+    statistics of the events, i.e. records other
+    than checkpoints, in one avro block of a cassette
+    '''
+    def __init__(self, offset, first_seq, num_events=0, modules=(),
+                 min_lno=None, max_lno=None, event_types=()):
+        '''
+        offset: file offset of the block
+        first_seq: seq, i.e. index in the cassette, of
+            the first event in the block
+        '''
+        self.offset = offset
+        self.first_seq = first_seq
+        self.num_events = num_events
+        self.modules = set(modules)
+        self.min_lno = min_lno
+        self.max_lno = max_lno
+        self.event_types = set(event_types)
+
+    def add(self, record):
+        lineno = record['module_lno']
+        if self.num_events == 0:
+            self.min_lno = self.max_lno = lineno
+        else:
+            self.min_lno = min(self.min_lno, lineno)
+            self.max_lno = max(self.max_lno, lineno)
+        self.num_events += 1
+        self.modules.add(record['module_path'])
+        self.event_types.add(record['event_type'])
+
+    def may_match(self, modules=None, lines=None, event_types=None, seq_range=None) -> bool:
+        '''
+        whether any event in the block may pass the
+        filters; see `get_records` for their meaning
+        '''
+        if self.num_events == 0:
+            return False
+        if modules is not None and self.modules.isdisjoint(modules):
+            return False
+        if lines is not None and (lines[1] < self.min_lno or lines[0] > self.max_lno):
+            return False
+        if event_types is not None and self.event_types.isdisjoint(event_types):
+            return False
+        if seq_range is not None and (seq_range[1] <= self.first_seq or
+                                      seq_range[0] >= self.first_seq + self.num_events):
+            return False
+        return True
+
+    def to_dict(self):
+        return {'offset': self.offset, 'first_seq': self.first_seq,
+                'num_events': self.num_events, 'modules': sorted(self.modules),
+                'min_lno': self.min_lno, 'max_lno': self.max_lno,
+                'event_types': sorted(self.event_types)}
+
+
+def block_stats_path(cassette_path: str) -> str:
+    return f'{cassette_path}.blk'
+
+
+def block_stats(cassette_path: str):
+    '''
+    list of `BlockStats` of the cassette; None if the
+    cassette was recorded without them
+    '''
+    import json
+    try:
+        with open(block_stats_path(cassette_path)) as fp:
+            # a line without a newline is being (or was
+            # partially) written by the recorder
+            return [BlockStats(**json.loads(line)) for line in fp
+                    if line.endswith('\n')]
+    except FileNotFoundError:
+        return None
+
+
+class CassetteWriter:
+    '''
+    appends records to a cassette.
+    Records are buffered into avro blocks; a block
+    is written when it grows large or on `flush`
+    '''
+    def __init__(self, fileptr, store, stats_fp=None):
+        '''
+        fileptr: cassette file opened for writing
+        store: `BlobStore` that payloads are put in
+        stats_fp: if given, `BlockStats` of each written
+            block are appended to it, as json lines
+        '''
+        from fastavro.write import Writer
+        self.fileptr = fileptr
+        self.store = store
+        self.stats_fp = stats_fp
+        self.writer = Writer(fileptr, event_schema())
+        # number of events, i.e. non checkpoint records, written
+        self.num_events = 0
+        # stats of the block being buffered
+        self.block = BlockStats(fileptr.tell(), 0)
+
+    def append(self, path: str, lineno: int, event: Event):
+        '''
+        append record and return it
+        '''
+        record = {'module_path': path,
+                  'module_lno': lineno,
+                  'event_type': to_symbol(event.__class__.__name__),
+                  'event_data': event.to_dict(self.store)}
+        if record['event_type'] != 'CHECKPOINT':
+            self.block.add(record)
+            self.num_events += 1
+        offset = self.fileptr.tell()
+        self.writer.write(record)
+        if self.fileptr.tell() != offset:
+            # the writer wrote the block, including this record
+            self._end_block()
+        return record
+
+    def _end_block(self):
+        if self.stats_fp is not None:
+            import json
+            self.stats_fp.write(json.dumps(self.block.to_dict()) + '\n')
+            # readers only use the stats of blocks listed;
+            # keep them in step with the cassette
+            self.stats_fp.flush()
+        self.block = BlockStats(self.fileptr.tell(), self.num_events)
+
+    def flush(self) -> int:
+        '''
+        end the current block; return the file offset
+        the next block starts at
+        '''
+        offset = self.fileptr.tell()
+        self.writer.flush()
+        if self.fileptr.tell() != offset:
+            self._end_block()
+        return self.fileptr.tell()
+
+    def close(self):
+        self.flush()
+        self.fileptr.close()
+        if self.stats_fp is not None:
+            self.stats_fp.close()
+
+
+def checkpoint_index_path(cassette_path: str) -> str:
+    return f'{cassette_path}.ckpt'
+
+
+def checkpoint_index(cassette_path: str) -> list:
     '''
-    append record to `fileptr`
+    sorted list of (seq, offset, full) of checkpoints in cassette;
+    `offset` is where the block starting with the checkpoint is,
+    `full` whether it's a full or a delta checkpoint
     '''
-    record = {'module_path': path,
-              'module_lno': lineno,
-              'event_type': to_symbol(event.__class__.__name__),
-              'event_data': event.to_dict()}
-    writer(fileptr, EVENT_SCHEMA, [record])
+    index = []
+    try:
+        with open(checkpoint_index_path(cassette_path)) as fp:
+            for line in fp:
+                # cassettes recorded before delta checkpoints
+                # have no `full` column
+                seq, offset, full = (line.split() + ['1'])[:3]
+                index.append((int(seq), int(offset), full == '1'))
+    except FileNotFoundError:
+        pass
+    return index
+
 
+def _normalize_filters(modules, lines, event_types, seq_range):
+    if modules is not None:
+        modules = set(modules)
+    if event_types is not None:
+        event_types = set(event_types)
+    return modules, lines, event_types, seq_range
 
-def get_records(filepath):
+
+def _record_matches(record, seq, modules, lines, event_types, seq_range) -> bool:
+    if modules is not None and record['module_path'] not in modules:
+        return False
+    if lines is not None and not lines[0] <= record['module_lno'] <= lines[1]:
+        return False
+    if event_types is not None and record['event_type'] not in event_types:
+        return False
+    if seq_range is not None and not seq_range[0] <= seq < seq_range[1]:
+        return False
+    return True
+
+
+def filter_records(records, modules=None, lines=None, event_types=None, seq_range=None):
     '''
-    generate records in `filepath`
+    filter a stream of records after decoding them;
+    see `get_records` for the filters.
+    Markers of dropped frames of a live stream (see `stream`)
+    are always passed through
     '''
+    filters = _normalize_filters(modules, lines, event_types, seq_range)
+    seq = 0
+    for record in records:
+        if record['event_type'] == 'CHECKPOINT':
+            continue
+        if record['event_type'] == 'DROPPED':
+            yield record
+            continue
+        if _record_matches(record, seq, *filters):
+            yield record
+        seq += 1
+
+
+def _block_records(block, seq, filters):
+    '''
+    events of `block` passing `filters`; `seq` is
+    the seq of the first event in the block
+    '''
+    for record in block:
+        if record['event_type'] == 'CHECKPOINT':
+            continue
+        if _record_matches(record, seq, *filters):
+            yield record
+        seq += 1
+
+
+def _filtered_records(filepath, filters, offset=None):
+    '''
+    read only blocks whose `BlockStats` may match `filters`,
+    from the block at `offset`, if given.
+    Blocks after the last one with stats, e.g. the cassette is
+    still being recorded, are decoded and filtered; as are all
+    blocks of cassettes recorded without stats
+    '''
+    stats = block_stats(filepath) or []
+    from fastavro import block_reader
     with open(filepath, 'rb') as fo:
-        for record in reader(fo):
+        # like `reader`, blocks are read lazily from
+        # the current position of `fo`
+        blocks = block_reader(fo)
+        for block_stat in stats:
+            if offset is not None and block_stat.offset < offset:
+                continue
+            if not block_stat.may_match(*filters):
+                continue
+            fo.seek(block_stat.offset)
+            yield from _block_records(next(blocks), block_stat.first_seq, filters)
+        seq = 0
+        if stats:
+            # skip past the last block with stats
+            last = stats[-1]
+            fo.seek(last.offset)
+            next(blocks)
+            seq = last.first_seq + last.num_events
+        for block in blocks:
+            records = list(block)
+            if offset is None or block.offset >= offset:
+                yield from _block_records(records, seq, filters)
+            seq += sum(record['event_type'] != 'CHECKPOINT' for record in records)
+
+
+def get_records(filepath, offset=None, modules=None, lines=None, event_types=None,
+                seq_range=None):
+    '''
+    generate records in `filepath`, optionally
+    starting from the block at `offset`.
+
+    If any filter is given, only events, i.e. no checkpoints,
+    passing all given filters are generated, and blocks that
+    can't contain such events are skipped without decoding:
+        modules: iterable of module paths
+        lines: (first, last) line numbers, inclusive
+        event_types: iterable of event type symbols, e.g. 'OBJECT_CREATED'
+        seq_range: (start, stop) of event seq, i.e. the index
+            of the event in the cassette, stop exclusive
+    With `offset`, blocks before it are skipped; seq is
+    still counted from the start of the cassette.
+    '''
+    filters = _normalize_filters(modules, lines, event_types, seq_range)
+    if any(f is not None for f in filters):
+        yield from _filtered_records(filepath, filters, offset)
+        return
+    from fastavro import reader
+    with open(filepath, 'rb') as fo:
+        # reading the header leaves `fo` at the first block;
+        # fastavro reads blocks lazily from the current position
+        records = reader(fo)
+        if offset is not None:
+            fo.seek(offset)
+        for record in records:
             yield record
 
 
 if __name__ == '__main__':
+    from fastavro import writer, reader
     # sanity check
-    records = [{'module_path': '', 'module_lno': 0, 'event_type': 'OBJECT_CREATED', 'event_data': {'object': b''}}]
+    records = [{'module_path': '', 'module_lno': 0, 'event_type': 'OBJECT_CREATED', 'event_data': {'object_hash': '', 'object_id': 0}}]
     with open('foo.avro', 'wb') as out:
-        writer(out, EVENT_SCHEMA, records)
+        writer(out, event_schema(), records)
 
     # Reading
     with open('foo.avro', 'rb') as fo:
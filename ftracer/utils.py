@@ -1,4 +1,6 @@
 import ast
+import functools
+import os
 import os.path
 import importlib.util
 
@@ -40,6 +42,19 @@ def load_module(module_path, module_name='__noname__'):
     return mod
 
 
+@functools.lru_cache(maxsize=None)
+def _load_config(config_path, mtime_ns):
+    return load_module(config_path, '__ftracer_config__')
+
+
+def load_config(config_path):
+    '''
+    load the config module at `config_path`;
+    it is only executed again if the file changed
+    '''
+    return _load_config(config_path, os.stat(config_path).st_mtime_ns)
+
+
 def to_abspath(path, parent=None):
     '''
     convert an rel/abs ambiguous path
@@ -51,6 +66,18 @@ def to_abspath(path, parent=None):
     return os.path.join(parent, path)
 
 
+def find_modules(package_dir: str) -> list:
+    '''
+    abs paths of all python modules under `package_dir`
+    '''
+    paths = []
+    for dirpath, _, filenames in os.walk(realpath(package_dir)):
+        for filename in filenames:
+            if filename.endswith('.py'):
+                paths.append(os.path.join(dirpath, filename))
+    return paths
+
+
 def env_str(env: dict, keys_only=True):
     '''
     Unused- Nuke
@@ -0,0 +1,184 @@
+'''
+names `NodeIndexer` binds for small source snippets
+'''
+import ast
+import textwrap
+
+import pytest
+
+from ftracer.ast_indexer import NodeIndexer
+
+
+def index(source, lazy=False):
+    indexer = NodeIndexer(lazy=lazy)
+    indexer.visit(ast.parse(textwrap.dedent(source)))
+    return indexer
+
+
+def names_before(source, lineno, lazy=False):
+    '''
+    (lineno, sorted names) of the last line before `lineno`
+    that binds names, in the scope containing `lineno`
+    '''
+    lno_names = index(source, lazy).prev_lno_names(lineno)
+    return lno_names.lineno, sorted(lno_names.names)
+
+
+def scope_names(source, lineno):
+    'all names bound in the scope containing `lineno`'
+    return sorted(index(source).containing_scope(lineno).lhs_children)
+
+
+def test_nested_and_starred_unpacking():
+    source = '''
+        def f():
+            (x, [y, *z]), d[0], obj.attr = g()
+            return x
+        '''
+    assert names_before(source, 4) == (3, ['x', 'y', 'z'])
+
+
+def test_attribute_targets_bind_no_name():
+    source = '''
+        def f(self):
+            self.id = 5
+            self.count += 1
+            self.size: int = 0
+            for self.i in []:
+                pass
+            with g() as self.ctx:
+                pass
+            return self
+        '''
+    assert names_before(source, 10) == (-1, [])
+    assert scope_names(source, 10) == ['self']
+
+
+def test_walrus_binds_in_enclosing_function():
+    source = '''
+        def f(a):
+            if (n := len(a)) > 1:
+                pass
+            total = [w for w in a if (m := w)]
+            return total
+        '''
+    assert names_before(source, 4) == (3, ['n'])
+    assert names_before(source, 6) == (5, ['m', 'total'])
+
+
+def test_comprehension_and_lambda_names_are_isolated():
+    source = '''
+        def f(a):
+            squares = [w * w for w in a]
+            pairs = {k: v for k, v in a}
+            fn = lambda q: q
+            return fn
+        '''
+    assert scope_names(source, 6) == ['a', 'fn', 'pairs', 'squares']
+
+
+def test_imports():
+    source = '''
+        import os.path
+        from collections import OrderedDict as OD, deque
+        from os import *
+
+        def f():
+            pass
+        '''
+    assert scope_names(source, 2) == ['OD', 'deque', 'f', 'os']
+
+
+def test_function_arguments():
+    source = '''
+        def f(a, /, b, *args, c, d=1, **kw):
+            return a
+        '''
+    assert scope_names(source, 3) == ['a', 'args', 'b', 'c', 'd', 'kw']
+
+
+def test_except_for_with_and_augmented_targets():
+    source = '''
+        def f(a):
+            try:
+                pass
+            except ValueError as exc:
+                pass
+            for i, j in a:
+                pass
+            with open(a) as fp, open(a) as (g1, g2):
+                pass
+            count: int = 0
+            count += 1
+            return count
+        '''
+    assert names_before(source, 6) == (5, ['exc'])
+    assert names_before(source, 8) == (7, ['i', 'j'])
+    assert names_before(source, 10) == (9, ['fp', 'g1', 'g2'])
+    assert names_before(source, 12) == (11, ['count'])
+    assert names_before(source, 13) == (12, ['count'])
+
+
+def test_match_captures():
+    source = '''
+        def f(a):
+            match a:
+                case [first, *rest]:
+                    pass
+                case {'k': v, **others}:
+                    pass
+                case Point(x=px) as pt:
+                    pass
+            return a
+        '''
+    assert names_before(source, 5) == (4, ['first', 'rest'])
+    assert names_before(source, 7) == (6, ['others', 'v'])
+    assert names_before(source, 9) == (8, ['pt', 'px'])
+
+
+def test_none_in_node_lists():
+    # `{**a}` has a None dict key; `*, c` a None kw default
+    source = '''
+        def f(a, *, c):
+            merged = {**a, 'k': 1}
+            return merged
+        '''
+    assert names_before(source, 4) == (3, ['merged'])
+
+
+LAZY_EAGER_SOURCE = '''
+    import os
+    x = 1
+
+    class A:
+        y = 2
+
+        def method(self, a):
+            z = [i for i in a]
+
+            def inner():
+                nonlocal z
+                z = 3
+                return z
+            return inner
+
+    async def g(b):
+        async for c in b:
+            pass
+        async with b as d:
+            e = 4
+        return e
+    '''
+
+
+@pytest.mark.parametrize('order', ['forward', 'backward'])
+def test_lazy_matches_eager(order):
+    num_lines = LAZY_EAGER_SOURCE.count('\n')
+    eager = index(LAZY_EAGER_SOURCE)
+    lazy = index(LAZY_EAGER_SOURCE, lazy=True)
+    linenos = range(2, num_lines + 1)
+    if order == 'backward':
+        # look up inner scopes before their parents were indexed
+        linenos = reversed(linenos)
+    for lineno in linenos:
+        assert lazy.prev_lno_names(lineno) == eager.prev_lno_names(lineno), lineno
@@ -0,0 +1,97 @@
+'''
+NORangeTree built with `add_node`, in and out of
+order, and `from_ranges` against a brute-force scope lookup
+'''
+import random
+
+import pytest
+
+from ftracer.custom_types import NORangeTree, UndefinedRelationship
+
+
+def random_ranges(rng, start, end, depth=0, ranges=None):
+    '''
+    nested, non-overlapping (start, end, val) ranges
+    within [start, end], including some equal ranges
+    '''
+    if ranges is None:
+        ranges = []
+    lineno = start
+    while lineno <= end and depth < 4:
+        if rng.random() < 0.3:
+            lineno += 1
+            continue
+        last = min(end, lineno + rng.randint(0, 20))
+        ranges.append((lineno, last, len(ranges)))
+        if rng.random() < 0.2:
+            ranges.append((lineno, last, len(ranges)))
+        if rng.random() < 0.6:
+            random_ranges(rng, lineno, last, depth + 1, ranges)
+        lineno = last + 1
+    return ranges
+
+
+def brute_scope_stack(ranges, lineno):
+    '''
+    values of ranges enclosing `lineno`, outermost first;
+    of equal ranges the earlier one is the parent
+    '''
+    enclosing = [(start, -end, i, val) for i, (start, end, val) in enumerate(ranges)
+                 if start <= lineno <= end]
+    return [val for *_, val in sorted(enclosing)]
+
+
+def scope_stack(rtree, lineno):
+    return [node.value for node in rtree.get_scope_stack(lineno).stack]
+
+
+def add_all(ranges):
+    rtree = NORangeTree()
+    for start, end, val in ranges:
+        rtree.add_node(start, end, val)
+    return rtree
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_matches_brute_force(seed):
+    rng = random.Random(seed)
+    ranges = random_ranges(rng, 1, 200)
+    if not ranges:
+        return
+    shuffled = ranges[:]
+    rng.shuffle(shuffled)
+    trees = [(add_all(ranges), ranges),
+             (add_all(shuffled), shuffled),
+             (NORangeTree.from_ranges(shuffled), shuffled)]
+    for lineno in range(0, 210):
+        for rtree, order in trees:
+            expected = brute_scope_stack(order, lineno)
+            assert scope_stack(rtree, lineno) == expected
+            innermost = rtree.innermost(lineno)
+            assert (innermost and innermost.value) == (expected[-1] if expected else None)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_lookups_between_adds(seed):
+    rng = random.Random(seed)
+    ranges = random_ranges(rng, 1, 100)
+    rng.shuffle(ranges)
+    rtree = NORangeTree()
+    for i, (start, end, val) in enumerate(ranges):
+        rtree.add_node(start, end, val)
+        for lineno in range(0, 110):
+            assert scope_stack(rtree, lineno) == brute_scope_stack(ranges[:i + 1], lineno)
+
+
+def test_overlap_leaves_tree_unchanged():
+    rtree = add_all([(1, 20, 'mod'), (1, 2, 'a'), (5, 6, 'b')])
+    with pytest.raises(UndefinedRelationship):
+        rtree.add_node(1, 5, 'bad')
+    assert scope_stack(rtree, 1) == ['mod', 'a']
+    assert scope_stack(rtree, 5) == ['mod', 'b']
+    assert sorted(rtree.values()) == ['a', 'b', 'mod']
+
+
+def test_from_ranges_overlap():
+    with pytest.raises(UndefinedRelationship):
+        NORangeTree.from_ranges([(1, 5, 'a'), (3, 8, 'b')])
@@ -0,0 +1,126 @@
+'''
+names recorded by `Tracer` from a traced run
+'''
+import string
+import sys
+import textwrap
+
+import ftracer._ftracer
+from ftracer import tape_utils as tu
+from ftracer.ast_indexer import IndexCache
+from ftracer.dynamic_trace import Tracer
+from ftracer.module_updater import compile_instrumented
+from ftracer.utils import load_module
+
+
+def make_tracer(tmp_path, source, name):
+    '''
+    write `source` to a module; return its path and
+    a `Tracer` of it recording to cassette `name`
+    '''
+    module_path = str(tmp_path / 'traced.py')
+    with open(module_path, 'w') as fp:
+        fp.write(textwrap.dedent(source))
+    config_path = tmp_path / 'config.py'
+    config_path.write_text(f'cassettes_dir = {str(tmp_path)!r}\n'
+                           f'blobs_dir = {str(tmp_path / "blobs")!r}\n')
+    tracer = Tracer([module_path], IndexCache(), cassette_path=str(tmp_path / name),
+                    config_path=str(config_path))
+    return module_path, tracer
+
+
+def recorded_objects(tracer):
+    return [record for record in tu.get_records(tracer.cassette_path)
+            if record['event_type'] == 'OBJECT_CREATED']
+
+
+def trace_module(tmp_path, source, func='run'):
+    '''
+    write `source` to a module, trace importing it and
+    calling its `func`; return (module, recorded events)
+    '''
+    module_path, tracer = make_tracer(tmp_path, source, 'A.avro')
+    sys.settrace(tracer)
+    try:
+        module = load_module(module_path, 'traced')
+        getattr(module, func)()
+    finally:
+        sys.settrace(None)
+        tracer.close()
+    return module, recorded_objects(tracer)
+
+
+def instrument_module(tmp_path, source, func='run'):
+    '''
+    like `trace_module`, but recording from instrumented code
+    '''
+    module_path, tracer = make_tracer(tmp_path, source, 'B.avro')
+    ftracer._ftracer._recorder = tracer
+    try:
+        namespace = {'__name__': 'traced'}
+        exec(compile_instrumented(module_path), namespace)
+        namespace[func]()
+    finally:
+        ftracer._ftracer._recorder = None
+        tracer.close()
+    return recorded_objects(tracer)
+
+
+def test_attribute_targets_are_not_resolved_as_names(tmp_path):
+    _, records = trace_module(tmp_path, '''
+        from string import ascii_letters as x
+
+        class Counter:
+            def __init__(self):
+                self.id = 5
+                self.list = []
+                self.x = 1
+                self.count = 0
+                self.count += 1
+                done = True
+                self.done = done
+
+        def run():
+            return Counter()
+        ''')
+    object_ids = {record['event_data']['object_id'] for record in records}
+    # builtins and the global `x` share names with attribute targets
+    assert id(id) not in object_ids
+    assert id(list) not in object_ids
+    assert id(string.ascii_letters) not in object_ids
+    assert id(True) in object_ids
+
+
+def test_unbound_names_are_skipped(tmp_path):
+    _, records = trace_module(tmp_path, '''
+        class Namespace:
+            if False:
+                id = 1
+            y = 2
+
+        def run():
+            global len
+            if False:
+                len = 1
+            return 0
+        ''')
+    object_ids = {record['event_data']['object_id'] for record in records}
+    # not bound yet; builtins of the same name must not be recorded
+    assert id(len) not in object_ids
+    assert id(id) not in object_ids
+
+
+def test_modes_record_events_at_binding_line(tmp_path):
+    source = '''
+        def run():
+            a = [1]
+            b = {'k': a}
+            for i in range(2):
+                c = (i, b)
+            return c
+        '''
+    _, traced = trace_module(tmp_path, source)
+    instrumented = instrument_module(tmp_path, source)
+    lines = [record['module_lno'] for record in traced]
+    assert lines == [3, 4, 5, 6]
+    assert [record['module_lno'] for record in instrumented] == lines
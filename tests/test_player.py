@@ -0,0 +1,76 @@
+'''
+`TapePlayer.state_at` against replaying every event
+'''
+import random
+
+import pytest
+
+from ftracer import tape_utils as tu
+from ftracer.dynamic_trace import Tracer
+from ftracer.player import TapePlayer
+
+
+def make_tracer(tmp_path, checkpoint_events):
+    config_path = tmp_path / 'config.py'
+    config_path.write_text(f'cassettes_dir = {str(tmp_path)!r}\n'
+                           f'blobs_dir = {str(tmp_path / "blobs")!r}\n'
+                           f'checkpoint_events = {checkpoint_events}\n')
+    return Tracer([], None, cassette_path=str(tmp_path / 'A.avro'),
+                  config_path=str(config_path))
+
+
+def record_objects(tracer, num_events, seed=0):
+    '''
+    record `num_events` new objects; about half are freed
+    right away, so their ids are reused by later objects
+    '''
+    rng = random.Random(seed)
+    kept = []
+    for i in range(num_events):
+        obj = [i]
+        if rng.random() < 0.5:
+            kept.append(obj)
+        tracer.record_values('/m.py', i, [('obj', obj)])
+    return kept
+
+
+def replayed_state(cassette_path, n):
+    state = {}
+    events = (record for record in tu.get_records(cassette_path)
+              if record['event_type'] != 'CHECKPOINT')
+    for seq, record in enumerate(events):
+        if seq >= n:
+            break
+        data = record['event_data']
+        state[data['object_id']] = data['object_hash']
+    return state
+
+
+def test_state_at_matches_replay(tmp_path):
+    tracer = make_tracer(tmp_path, checkpoint_events=50)
+    # kept objects must stay alive while recording
+    kept = record_objects(tracer, 3000)  # noqa: F841
+    tracer.close()
+    index = tu.checkpoint_index(tracer.cassette_path)
+    assert index[0][2]
+    assert not all(full for _, _, full in index)
+    # checkpoint entries grow linearly with events
+    checkpoints = [record['event_data'] for record in tu.get_records(tracer.cassette_path)
+                   if record['event_type'] == 'CHECKPOINT']
+    assert len(checkpoints) == len(index)
+    assert sum(len(data['object_ids']) for data in checkpoints) <= 2 * 3000
+    player = TapePlayer(tracer.cassette_path, step=False)
+    for n in [0, 1, 49, 50, 51, 999, 1000, 1234, 2999, 3000, 4000]:
+        assert player.state_at(n) == replayed_state(tracer.cassette_path, n), n
+
+
+@pytest.mark.parametrize('num_events', [50, 51, 120])
+def test_state_at_while_recording(tmp_path, num_events):
+    # checkpoints are indexed before their record reaches the cassette
+    tracer = make_tracer(tmp_path, checkpoint_events=50)
+    kept = record_objects(tracer, num_events)  # noqa: F841
+    tracer.cassette.fileptr.flush()
+    player = TapePlayer(tracer.cassette_path, step=False)
+    for n in range(num_events - 2, num_events + 1):
+        assert player.state_at(n) == replayed_state(tracer.cassette_path, n), n
+    tracer.close()
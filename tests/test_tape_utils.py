@@ -0,0 +1,155 @@
+'''
+filtered reads of cassettes with `get_records` against
+decoding every record and filtering with `filter_records`
+'''
+import os
+import random
+
+import pytest
+
+from ftracer import tape_utils as tu
+
+
+class FakeStore:
+    'payloads are their own keys'
+    def put(self, data):
+        return data
+
+
+class FakeObjectCreated(tu.Event):
+    def __init__(self, key):
+        self.key = key
+
+    def to_dict(self, store):
+        return {'object_hash': self.key, 'object_id': 0}
+
+
+# appended records are typed by the event's class name
+FakeObjectCreated.__name__ = 'ObjectCreated'
+
+NUM_EVENTS = 20000
+# for tests writing their own cassette
+SMALL_NUM_EVENTS = 6000
+
+FILTERS = [
+    dict(modules=['/m3.py']),
+    dict(lines=(10, 20)),
+    dict(seq_range=(12345, 12400)),
+    dict(modules=['/m3.py'], lines=(1, 3)),
+    dict(event_types=['CHECKPOINT']),
+    dict(event_types=['OBJECT_CREATED'], seq_range=(0, 5)),
+]
+
+
+def write_cassette(path, num_events=NUM_EVENTS, close=True):
+    '''
+    a cassette whose flow stays in one module for a while,
+    with a checkpoint every few thousand events
+    '''
+    rng = random.Random(0)
+    writer = tu.CassetteWriter(open(path, 'wb'), FakeStore(),
+                               open(tu.block_stats_path(path), 'w'))
+    for seq in range(num_events):
+        module = f'/m{seq // 2000 % 10}.py'
+        writer.append(module, rng.randint(1, 500), FakeObjectCreated(f'h{seq}'))
+        if seq % 3001 == 3000:
+            writer.flush()
+            writer.append(module, 0, tu.Checkpoint(seq + 1, {}))
+    if close:
+        writer.close()
+    return writer
+
+
+@pytest.fixture(scope='module')
+def cassette(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('cassette') / 'A.avro')
+    write_cassette(path)
+    return path
+
+
+def filtered(path, filters, offset=None):
+    '''
+    expected result of a filtered read, from the
+    block at `offset`, if given
+    '''
+    if offset is None:
+        return list(tu.filter_records(tu.get_records(path), **filters))
+    first_seq = next(stat.first_seq for stat in tu.block_stats(path)
+                     if stat.offset == offset)
+    start, stop = filters.get('seq_range') or (0, float('inf'))
+    record_filters = {name: value for name, value in filters.items() if name != 'seq_range'}
+    events = (record for record in tu.get_records(path)
+              if record['event_type'] != 'CHECKPOINT')
+    return [record for seq, record in enumerate(events)
+            if max(start, first_seq) <= seq < stop
+            and list(tu.filter_records([record], **record_filters))]
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_filtered_read_matches_filter_records(cassette, filters):
+    assert list(tu.get_records(cassette, **filters)) == filtered(cassette, filters)
+
+
+@pytest.mark.parametrize('filters, max_blocks', [
+    (dict(modules=['/m3.py']), 4),
+    (dict(seq_range=(12345, 12400)), 1),
+    (dict(event_types=['CHECKPOINT']), 0),
+])
+def test_blocks_are_skipped(cassette, monkeypatch, filters, max_blocks):
+    decoded = []
+    block_records = tu._block_records
+
+    def counting_block_records(block, seq, filters):
+        decoded.append(seq)
+        return block_records(block, seq, filters)
+
+    monkeypatch.setattr(tu, '_block_records', counting_block_records)
+    assert list(tu.get_records(cassette, **filters)) == filtered(cassette, filters)
+    assert len(decoded) <= max_blocks < len(tu.block_stats(cassette))
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_read_without_block_stats(tmp_path, filters):
+    path = str(tmp_path / 'A.avro')
+    write_cassette(path, SMALL_NUM_EVENTS)
+    os.remove(tu.block_stats_path(path))
+    assert list(tu.get_records(path, **filters)) == filtered(path, filters)
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_read_with_partial_block_stats(tmp_path, filters):
+    # e.g. the recorder was killed while writing the stats
+    path = str(tmp_path / 'A.avro')
+    write_cassette(path, SMALL_NUM_EVENTS)
+    stats_path = tu.block_stats_path(path)
+    with open(stats_path) as fp:
+        lines = fp.readlines()
+    with open(stats_path, 'w') as fp:
+        fp.writelines(lines[:len(lines) // 2])
+        fp.write(lines[len(lines) // 2][:10])
+    assert len(tu.block_stats(path)) == len(lines) // 2
+    assert list(tu.get_records(path, **filters)) == filtered(path, filters)
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_read_while_recording(tmp_path, filters):
+    path = str(tmp_path / 'A.avro')
+    writer = write_cassette(path, SMALL_NUM_EVENTS, close=False)
+    writer.fileptr.flush()
+    try:
+        assert list(tu.get_records(path, **filters)) == filtered(path, filters)
+    finally:
+        writer.close()
+
+
+@pytest.mark.parametrize('filters', FILTERS + [dict(seq_range=(4000, 4100))])
+@pytest.mark.parametrize('without_stats', [False, True])
+def test_filtered_read_from_offset(tmp_path, filters, without_stats):
+    path = str(tmp_path / 'A.avro')
+    write_cassette(path, SMALL_NUM_EVENTS)
+    stats = tu.block_stats(path)
+    offset = stats[len(stats) // 2].offset
+    expected = filtered(path, filters, offset)
+    if without_stats:
+        os.remove(tu.block_stats_path(path))
+    assert list(tu.get_records(path, offset, **filters)) == expected